@@ -0,0 +1,550 @@
+"""Synthetic data and benchmark commands for the forum.
+
+The commands are added to the app's CLI when this module is loaded, so they run
+with ``flask --app bench`` (``flask --app bench seed``, ``flask --app bench bench``);
+main.py never imports it, so neither do the processes that serve requests. The
+app's own commands are available there too.
+"""
+from flask import url_for
+from sqlalchemy import event, create_engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import joinedload
+from collections import Counter
+import os
+import time
+import threading
+import re
+import json
+import logging
+import click
+import tempfile
+import multiprocessing
+import random
+import subprocess
+import http.cookiejar
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime, timedelta
+
+from main import (app, db, User, Thread, Post, Message, ASSETS, apply_sqlite_pragmas, check_database_option,
+                  encode_cursor, engine_options, ensure_check_fixtures, log_in_test_client, page_cache,
+                  paginate_threads, password_hasher, rebuild_hot_scores, rebuild_thread_counters, render_body,
+                  request_logger, rerun_in_check_database, view_count)
+
+# Benchmarks
+def time_render(template, context, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        template.render(**context)
+    return (time.perf_counter() - started) * 1000 / iterations
+
+@app.cli.command('bench-render')
+@click.option('--iterations', default=200, show_default=True)
+@check_database_option
+def bench_render(iterations, database):
+    """Compare per-request render time with and without the compiled template cache."""
+    if rerun_in_check_database(database):
+        return
+    with app.test_request_context():
+        alice, bob, thread = ensure_check_fixtures()
+        page = paginate_threads(Thread.query.options(joinedload(Thread.author), joinedload(Thread.last_poster)),
+                                per_page=app.config['FORUM_PAGE_SIZE'])
+        posts = Post.query.options(joinedload(Post.author)).filter_by(thread_id=thread.id).all()
+        messages = Message.query.filter(Message.sender_id.in_([alice.id, bob.id])).all()
+        common = {'current_user': alice, 'view_count': view_count}
+        pages = [
+            ('forum', 'forum.html', dict(common, threads=page.items, page=page)),
+            ('thread', 'thread.html', dict(common, thread=thread, posts=posts)),
+            ('chat', 'chat.html', dict(common, receiver=bob, messages=messages)),
+        ]
+        # The old code handed the full page source to render_template_string, which
+        # compiles it on every call; an uncached environment reproduces that cost.
+        uncached = app.jinja_env.overlay(cache_size=0)
+        for label, name, context in pages:
+            before = time_render(uncached.get_template(name), context, iterations)
+            after = time_render(app.jinja_env.get_template(name), context, iterations)
+            click.echo(f'{label:8} compiled per request: {before:7.3f} ms   '
+                       f'precompiled: {after:7.3f} ms   ({before / after:.1f}x)')
+
+def mixed_load_worker(url, tuned, role, worker, seconds, results):
+    """One process of the concurrency benchmark, standing in for a gunicorn worker."""
+    engine = create_engine(url, **(engine_options(url) if tuned else {}))
+    if tuned:
+        event.listen(engine, 'connect', apply_sqlite_pragmas)
+    threads, posts = Thread.__table__, Post.__table__
+    listing = db.select(threads).order_by(threads.c.updated_at.desc(), threads.c.id.desc()).limit(25)
+    counts = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        try:
+            if role == 'reads':
+                with engine.connect() as conn:
+                    conn.execute(listing).all()
+            else:
+                thread_id = 1 + (counts['writes'] * 7 + worker) % 200
+                with engine.begin() as conn:
+                    conn.execute(posts.insert().values(content='yük testi', user_id=1, thread_id=thread_id,
+                                                       created_at=datetime.utcnow()))
+                    conn.execute(threads.update().where(threads.c.id == thread_id)
+                                 .values(reply_count=threads.c.reply_count + 1, updated_at=datetime.utcnow()))
+            counts[role] += 1
+        except OperationalError:
+            counts['errors'] += 1
+    engine.dispose()
+    results.put(dict(counts))
+
+@app.cli.command('bench-concurrency')
+@click.option('--seconds', default=5.0, show_default=True)
+@click.option('--readers', default=8, show_default=True)
+@click.option('--writers', default=2, show_default=True)
+def bench_concurrency(seconds, readers, writers):
+    """Compare mixed read/write throughput on SQLite before and after the connection tuning."""
+    for label, tuned in (('default', False), ('tuned', True)):
+        with tempfile.TemporaryDirectory() as tmp:
+            url = 'sqlite:///' + os.path.join(tmp, 'bench.db')
+            engine = create_engine(url, **(engine_options(url) if tuned else {}))
+            if tuned:
+                event.listen(engine, 'connect', apply_sqlite_pragmas)
+            db.metadata.create_all(engine)
+            with engine.begin() as conn:
+                conn.execute(User.__table__.insert().values(username='bench', password_hash='-'))
+                conn.execute(Thread.__table__.insert(), [
+                    {'title': f'Konu {i}', 'content': '-', 'user_id': 1, 'created_at': datetime.utcnow(),
+                     'updated_at': datetime.utcnow(), 'views': 0, 'reply_count': 0} for i in range(200)])
+            engine.dispose()
+            context = multiprocessing.get_context('fork')
+            results = context.Queue()
+            roles = ['reads'] * readers + ['writes'] * writers
+            processes = [context.Process(target=mixed_load_worker, args=(url, tuned, role, i, seconds, results))
+                         for i, role in enumerate(roles)]
+            for process in processes:
+                process.start()
+            total = sum((Counter(results.get()) for _ in processes), Counter())
+            for process in processes:
+                process.join()
+            reads, writes, errors = total['reads'], total['writes'], total['errors']
+        click.echo(f'{label:8} reads/s: {reads / seconds:9.1f}   writes/s: {writes / seconds:8.1f}   '
+                   f'errors: {errors}')
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def login_load_worker(url, username, deadline, counts):
+    client = app.test_client()
+    while time.monotonic() < deadline:
+        response = client.post(url, data={'username': username, 'password': 'check'})
+        counts[response.status_code] += 1
+
+def page_load_worker(url, deadline, latencies):
+    client = app.test_client()
+    while time.monotonic() < deadline:
+        started = time.perf_counter()
+        client.get(url)
+        latencies.append((time.perf_counter() - started) * 1000)
+
+@app.cli.command('bench-login')
+@click.option('--seconds', default=5.0, show_default=True)
+@click.option('--logins', default=8, show_default=True, help='Threads submitting the login form.')
+@click.option('--readers', default=2, show_default=True, help='Threads loading the forum page.')
+@check_database_option
+def bench_login(seconds, logins, readers, database):
+    """Measure login throughput and forum latency in one process, hashing inline and on the pool."""
+    if rerun_in_check_database(database):
+        return
+    with app.test_request_context():
+        alice, _, _ = ensure_check_fixtures()
+        forum_url, login_url = url_for('forum'), url_for('login')
+    # Time the page itself, not a cached copy of it.
+    app.config['PAGE_CACHE_ENABLED'] = False
+    # Log slow requests only.
+    request_logger.setLevel(logging.WARNING)
+    pool_workers = app.config['PASSWORD_HASH_WORKERS'] or 2
+    # The pool is created on first use, so the inline run has to come first.
+    for label, workers, login_threads in (('idle', 0, 0), ('inline', 0, logins), ('pool', pool_workers, logins)):
+        app.config['PASSWORD_HASH_WORKERS'] = workers
+        deadline = time.monotonic() + seconds
+        counts, latencies = Counter(), []
+        threads = ([threading.Thread(target=login_load_worker, args=(login_url, alice.username, deadline, counts))
+                    for _ in range(login_threads)] +
+                   [threading.Thread(target=page_load_worker, args=(forum_url, deadline, latencies))
+                    for _ in range(readers)])
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        latencies.sort()
+        click.echo(f'{label:7} logins/s: {counts[302] / seconds:7.1f}   rejected/s: {counts[503] / seconds:7.1f}   '
+                   f'forum p50: {percentile(latencies, 0.5):7.1f} ms   p95: {percentile(latencies, 0.95):7.1f} ms')
+
+@app.cli.command('bench-body-html')
+@click.option('--iterations', default=5, show_default=True)
+def bench_body_html(iterations):
+    """Compare the render time of the longest thread's replies: inline conversion versus stored HTML."""
+    with app.test_request_context():
+        thread = Thread.query.order_by(Thread.reply_count.desc(), Thread.id).first()
+        if thread is None:
+            raise click.UsageError('There are no threads to measure; run `flask --app bench seed` first.')
+        posts = Post.query.filter_by(thread_id=thread.id).order_by(Post.created_at, Post.id).all()
+        for post in posts:
+            if post.content_html is None:
+                post.content_html = render_body(post.content)
+        # The expression every template used before bodies were stored.
+        inline = app.jinja_env.from_string("{% for post in posts %}{{ post.content|replace('\\n', '<br>')|safe }}"
+                                           "{% endfor %}")
+        stored = app.jinja_env.from_string('{% for post in posts %}{{ post|body_html }}{% endfor %}')
+        before = time_render(inline, {'posts': posts}, iterations)
+        after = time_render(stored, {'posts': posts}, iterations)
+        started = time.perf_counter()
+        for post in posts:
+            render_body(post.content)
+        convert = (time.perf_counter() - started) * 1000
+        db.session.rollback()
+    click.echo(f'{len(posts)} replies   inline replace: {before:8.2f} ms   stored HTML: {after:8.2f} ms   '
+               f'({before / after:.1f}x); render_body at write time: {convert / max(len(posts), 1) * 1000:.1f} us/reply')
+
+@app.cli.command('measure-bytes')
+@check_database_option
+def measure_bytes(database):
+    """Bytes on the wire for each page, with CSS/JS inlined and uncompressed versus now.
+
+    "Before" is the uncompressed page plus the asset bytes it would have inlined.
+    "First visit" is the compressed page plus its compressed assets; on a repeat
+    visit the assets come from the browser cache.
+    """
+    if rerun_in_check_database(database):
+        return
+    with app.test_request_context():
+        me, _, peer, thread = bench_targets(fixtures=True)
+        scenarios = [s for s in bench_scenarios(me, peer, thread, writes=False) if s[1] == 'GET']
+        prefix = url_for('asset', name='')
+    request_logger.setLevel(logging.WARNING)
+    totals = Counter()
+    click.echo(f"{'page':20} {'before':>9} {'first visit':>12} {'repeat visit':>13}")
+    for name, method, url, data, logged_in, expected in scenarios:
+        client = app.test_client()
+        if logged_in:
+            log_in_test_client(client, me)
+        # A fresh app context gives each request its own `g` and login state.
+        with app.app_context():
+            plain = client.get(url).get_data()
+        with app.app_context():
+            compressed = client.get(url, headers={'Accept-Encoding': 'gzip, br'}).get_data()
+        assets = [ASSETS[path] for path in re.findall(re.escape(prefix) + r'([^"]+)', plain.decode())]
+        before = len(plain) + sum(len(asset.identity) for asset in assets)
+        first = len(compressed) + sum(len(asset.br or asset.gzip) for asset in assets)
+        totals.update(before=before, first=first, repeat=len(compressed))
+        click.echo(f'{name:20} {before:9} {first:12} {len(compressed):13}')
+    click.echo(f"{'total':20} {totals['before']:9} {totals['first']:12} {totals['repeat']:13}")
+
+# Synthetic data and benchmarks
+SEED_PASSWORD = 'seed'
+SEED_WORDS = ('mahkeme karar dava hakim avukat tanık delil itiraz temyiz duruşma savunma iddia dosya ceza '
+              'hukuk kanun madde yorum soru cevap bence aslında kesinlikle belki neden nasıl ne zaman').split()
+
+def zipf_cum_weights(n, exponent):
+    """Cumulative weights for random.choices where rank k is drawn in proportion to 1 / k**exponent."""
+    total, weights = 0.0, []
+    for rank in range(1, n + 1):
+        total += rank ** -exponent
+        weights.append(total)
+    return weights
+
+def insert_in_batches(table, rows, batch_size):
+    """executemany ``rows`` into ``table``, one transaction per batch; returns the row count."""
+    inserted, batch = 0, []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            with db.engine.begin() as conn:
+                conn.execute(table.insert(), batch)
+            inserted, batch = inserted + len(batch), []
+    if batch:
+        with db.engine.begin() as conn:
+            conn.execute(table.insert(), batch)
+        inserted += len(batch)
+    return inserted
+
+def next_id(model):
+    return (db.session.query(db.func.max(model.id)).scalar() or 0) + 1
+
+def advance_id_sequences(*models):
+    """Move PostgreSQL id sequences past rows that were inserted with explicit ids."""
+    if db.engine.dialect.name != 'postgresql':
+        return  # SQLite and MySQL continue from the largest id on their own.
+    with db.engine.begin() as conn:
+        for model in models:
+            table = model.__tablename__
+            conn.exec_driver_sql(f"SELECT setval(pg_get_serial_sequence('\"{table}\"', 'id'), "
+                                 f'(SELECT max(id) FROM "{table}"))')
+
+@app.cli.command('seed')
+@click.option('--users', default=1000, show_default=True)
+@click.option('--threads', default=5000, show_default=True)
+@click.option('--posts', default=100000, show_default=True)
+@click.option('--messages', default=50000, show_default=True)
+@click.option('--conversations', default=500, show_default=True)
+@click.option('--days', default=365, show_default=True, help='How far back timestamps are spread.')
+@click.option('--zipf', 'exponent', default=1.1, show_default=True, help='Skew of thread, user and DM activity.')
+@click.option('--batch-size', default=5000, show_default=True)
+@click.option('--random-seed', default=1, show_default=True)
+def seed(users, threads, posts, messages, conversations, days, exponent, batch_size, random_seed):
+    """Bulk-insert synthetic users, threads, replies and messages for load testing.
+
+    Replies, authorship and conversation length all follow a Zipf distribution, so a
+    few threads collect most of the replies and a few DMs run to thousands of
+    messages. Seeded users are named seed_<id> and share the password "seed".
+    Reply counters, rendered bodies and the search index are kept consistent with
+    the inserted rows.
+    """
+    started = time.perf_counter()
+    rng = random.Random(random_seed)
+    now = datetime.utcnow()
+    earliest = now - timedelta(days=days)
+
+    def moment(after=earliest):
+        return after + (now - after) * rng.random()
+
+    def text(low, high):
+        return ' '.join(rng.choices(SEED_WORDS, k=rng.randint(low, high)))
+
+    def body(low, high):
+        content = text(low, high)
+        return {'content': content, 'content_html': render_body(content)}
+
+    first_user, first_thread = next_id(User), next_id(Thread)
+    user_ids = list(range(first_user, first_user + users))
+    thread_ids = list(range(first_thread, first_thread + threads))
+    # Shuffled so that the busiest threads and users are spread over the id range.
+    rng.shuffle(user_ids)
+    rng.shuffle(thread_ids)
+    user_weights = zipf_cum_weights(users, exponent)
+    password_hash = password_hasher.hash(SEED_PASSWORD)
+    joined = {user_id: moment() for user_id in user_ids}
+    insert_in_batches(User.__table__, ({'id': user_id, 'username': f'seed_{user_id}', 'password_hash': password_hash,
+                                        'bio': text(3, 20), 'profile_pic': 'default.jpg', 'join_date': joined[user_id]}
+                                       for user_id in sorted(user_ids)), batch_size)
+
+    reply_targets = rng.choices(thread_ids, cum_weights=zipf_cum_weights(threads, exponent), k=posts)
+    replies = Counter(reply_targets)
+    created = {thread_id: moment() for thread_id in thread_ids}
+    authors = dict(zip(sorted(thread_ids), rng.choices(user_ids, cum_weights=user_weights, k=threads)))
+    insert_in_batches(Thread.__table__, ({'id': thread_id, 'title': text(2, 8).capitalize(), **body(20, 200),
+                                          'user_id': authors[thread_id], 'created_at': created[thread_id],
+                                          'updated_at': created[thread_id],
+                                          'views': replies[thread_id] * rng.randint(5, 50) + rng.randint(0, 100),
+                                          'reply_count': 0} for thread_id in sorted(thread_ids)), batch_size)
+    advance_id_sequences(User, Thread)
+    insert_in_batches(Post.__table__, ({**body(3, 80), 'thread_id': thread_id, 'created_at': moment(created[thread_id]),
+                                        'user_id': rng.choices(user_ids, cum_weights=user_weights)[0]}
+                                       for thread_id in reply_targets), batch_size)
+    for start in range(0, threads, 10000):
+        rebuild_thread_counters(sorted(thread_ids)[start:start + 10000])
+    db.session.execute(db.update(Thread).where(Thread.id >= first_thread)
+                       .values(updated_at=db.func.coalesce(Thread.last_post_at, Thread.created_at))
+                       .execution_options(synchronize_session=False))
+    db.session.commit()
+    with db.engine.begin() as conn:
+        for start in range(0, threads, 10000):
+            rebuild_hot_scores(conn, sorted(thread_ids)[start:start + 10000])
+
+    pairs = [tuple(rng.sample(user_ids, 2)) for _ in range(conversations)] if users > 1 else []
+    conversation_of = rng.choices(pairs, cum_weights=zipf_cum_weights(len(pairs), exponent), k=messages) if pairs else []
+    # Everything but the last two days of each conversation has been read.
+    read_before = now - timedelta(days=2)
+
+    def message(pair):
+        sender, receiver = pair if rng.random() < 0.5 else pair[::-1]
+        sent = moment(max(joined[sender], joined[receiver]))
+        return {**body(1, 30), 'sender_id': sender, 'receiver_id': receiver, 'created_at': sent,
+                'is_read': sent < read_before}
+
+    insert_in_batches(Message.__table__, (message(pair) for pair in conversation_of), batch_size)
+    page_cache.invalidate('forum')
+    click.echo(f'Seeded {users} users, {threads} threads, {posts} replies and {len(conversation_of)} messages '
+               f'in {time.perf_counter() - started:.1f} s.')
+
+def bench_targets(fixtures=False):
+    """The users, thread and conversation the benchmark requests point at.
+
+    Seeded data is preferred: the busiest thread, and the longest conversation
+    between seed users. Otherwise the check fixtures are used if ``fixtures`` is
+    set, which only commands running in a check database do.
+    """
+    thread = Thread.query.order_by(Thread.reply_count.desc(), Thread.id).first()
+    pair = (db.session.query(Message.sender_id, Message.receiver_id)
+            .join(User, User.id == Message.sender_id).filter(User.username.like('seed\\_%', escape='\\'))
+            .group_by(Message.sender_id, Message.receiver_id)
+            .order_by(db.func.count().desc()).first())
+    if thread is None or pair is None:
+        if not fixtures:
+            raise click.UsageError('There is no seeded conversation to benchmark; run `flask --app bench seed` first.')
+        alice, bob, thread = ensure_check_fixtures()
+        return alice, 'check', bob, thread
+    return db.session.get(User, pair[0]), SEED_PASSWORD, db.session.get(User, pair[1]), thread
+
+def bench_scenarios(me, peer, thread, writes):
+    """(name, method, url, form data, logged in, expected status) for every benchmarked request.
+
+    chat_stream (a long-lived stream) and avatar (a static file) are left out.
+    """
+    scenarios = [
+        ('home', 'GET', url_for('home'), None, False, 200),
+        ('register', 'GET', url_for('register'), None, False, 200),
+        ('login', 'GET', url_for('login'), None, False, 200),
+        ('forum', 'GET', url_for('forum'), None, False, 200),
+        ('forum_logged_in', 'GET', url_for('forum'), None, True, 200),
+        ('forum_older', 'GET', url_for('forum', after=encode_cursor(thread.updated_at, thread.id)), None, False, 200),
+        ('forum_hot', 'GET', url_for('forum', sort='hot'), None, False, 200),
+        ('thread', 'GET', url_for('thread', thread_id=thread.id), None, False, 200),
+        ('thread_logged_in', 'GET', url_for('thread', thread_id=thread.id), None, True, 200),
+        ('user_profile', 'GET', url_for('user_profile', username=me.username), None, False, 200),
+        ('search', 'GET', url_for('search', q=thread.title.split()[0]), None, False, 200),
+        ('profile', 'GET', url_for('profile'), None, True, 200),
+        ('create_thread_form', 'GET', url_for('create_thread'), None, True, 200),
+        ('inbox', 'GET', url_for('inbox'), None, True, 200),
+        ('chat', 'GET', url_for('chat', user_id=peer.id), None, True, 200),
+        ('chat_older', 'GET', url_for('chat_older', user_id=peer.id, before=encode_cursor(datetime.utcnow(), 0)),
+         None, True, 200),
+        ('internal_stats', 'GET', url_for('internal_stats'), None, False, 200),
+        ('api_threads', 'GET', url_for('api_threads'), None, False, 200),
+        ('api_thread', 'GET', url_for('api_thread', thread_id=thread.id), None, False, 200),
+        ('api_chat', 'GET', url_for('api_chat', user_id=peer.id), None, True, 200),
+    ]
+    if writes:
+        scenarios += [
+            ('thread_reply', 'POST', url_for('thread', thread_id=thread.id), {'content': 'Yük testi yorumu'}, True, 302),
+            ('chat_send', 'POST', url_for('chat', user_id=peer.id), {'content': 'Yük testi mesajı'}, True, 302),
+            ('create_thread', 'POST', url_for('create_thread'),
+             {'title': 'Yük testi', 'content': 'Yük testi konusu'}, True, 302),
+        ]
+    return scenarios
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+class HTTPBenchClient:
+    """Issues benchmark requests to a running server, keeping its own cookies."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()),
+                                                  NoRedirect())
+
+    def request(self, method, url, data=None):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        try:
+            with self.opener.open(urllib.request.Request(self.base_url + url, data=body, method=method)) as response:
+                response.read()
+                return response.status, response.headers.get('Server-Timing')
+        except urllib.error.HTTPError as error:
+            error.read()
+            return error.code, error.headers.get('Server-Timing')
+
+class TestBenchClient:
+    """Issues benchmark requests through the Flask test client."""
+
+    def __init__(self):
+        self.client = app.test_client()
+
+    def request(self, method, url, data=None):
+        response = self.client.open(url, method=method, data=data)
+        response.close()
+        return response.status_code, response.headers.get('Server-Timing')
+
+def parse_server_timing(header):
+    """The statement count and DB and render milliseconds from a Server-Timing header."""
+    if not header:
+        return None
+    match = re.search(r'db;dur=([\d.]+);desc="(\d+) queries", render;dur=([\d.]+)', header)
+    return (int(match[2]), float(match[1]), float(match[3])) if match else None
+
+def bench_worker(make_client, login, scenario, count, results):
+    method, url, data, logged_in, expected = scenario[1:]
+    client = make_client()
+    if logged_in:
+        login(client)
+    latencies, errors, timings = [], 0, []
+    for _ in range(count):
+        started = time.perf_counter()
+        status, server_timing = client.request(method, url, data)
+        latencies.append((time.perf_counter() - started) * 1000)
+        timings.append(parse_server_timing(server_timing))
+        errors += status != expected
+    results.append((latencies, errors, timings))
+
+@app.cli.command('bench')
+@click.option('--http', 'base_url', default=None,
+              help='Base URL of a running server such as http://127.0.0.1:8000; the test client is used otherwise.')
+@click.option('--requests', 'count', default=100, show_default=True, help='Requests per route and client thread.')
+@click.option('--concurrency', default=1, show_default=True, help='Client threads per route.')
+@click.option('--writes/--no-writes', default=True, show_default=True, help='Also benchmark the POST routes.')
+@click.option('--only', multiple=True, help='Benchmark only these scenarios.')
+@click.option('--output', type=click.Path(dir_okay=False), help='Write the results to this JSON file.')
+def bench(base_url, count, concurrency, writes, only, output):
+    """Measure latency percentiles, SQL statements and throughput for every route.
+
+    With --http the requests go to a running server (e.g. gunicorn) over real HTTP.
+    SQL and render figures are the medians of the Server-Timing headers. Run
+    `flask --app bench seed` first; the requests use its users and busiest thread. Compare the JSON output of two
+    commits to spot regressions.
+    """
+    with app.test_request_context():
+        me, password, peer, thread = bench_targets()
+        scenarios = [s for s in bench_scenarios(me, peer, thread, writes) if not only or s[0] in only]
+        login_url = url_for('login')
+    # Log slow requests only.
+    request_logger.setLevel(logging.WARNING)
+    if base_url:
+        make_client = lambda: HTTPBenchClient(base_url)
+        login = lambda client: client.request('POST', login_url, {'username': me.username, 'password': password})
+    else:
+        make_client = TestBenchClient
+        login = lambda client: log_in_test_client(client.client, me)
+    report = {'mode': 'http' if base_url else 'test-client', 'base_url': base_url, 'commit': git_commit(),
+              'started_at': datetime.utcnow().isoformat(), 'requests_per_thread': count,
+              'concurrency': concurrency, 'routes': {}}
+    for scenario in scenarios:
+        results = []
+        workers = [threading.Thread(target=bench_worker, args=(make_client, login, scenario, count, results))
+                   for _ in range(concurrency)]
+        started = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - started
+        latencies = sorted(latency for result in results for latency in result[0])
+        timings = [timing for result in results for timing in result[2] if timing is not None]
+        medians = [percentile(sorted(column), 0.5) for column in zip(*timings)] or [None] * 3
+        route = {
+            'requests': len(latencies),
+            'errors': sum(result[1] for result in results),
+            'throughput_rps': round(len(latencies) / elapsed, 1),
+            'p50_ms': round(percentile(latencies, 0.50), 2),
+            'p95_ms': round(percentile(latencies, 0.95), 2),
+            'p99_ms': round(percentile(latencies, 0.99), 2),
+            'sql_statements': medians[0],
+            'db_ms': medians[1],
+            'render_ms': medians[2],
+        }
+        report['routes'][scenario[0]] = route
+        click.echo(f"{scenario[0]:20} p50 {route['p50_ms']:8.2f}  p95 {route['p95_ms']:8.2f}  "
+                   f"p99 {route['p99_ms']:8.2f} ms  {route['throughput_rps']:8.1f} req/s  "
+                   f"sql {'-' if medians[0] is None else medians[0]:>3}  errors {route['errors']}")
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        click.echo(f'Results written to {output}.')
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=app.root_path).stdout.strip() or None
+    except OSError:
+        return None
+
@@ -0,0 +1,40 @@
+import os
+
+wsgi_app = 'main:app'
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', '4'))
+# Threaded workers, so open chat streams (Server-Sent Events) do not each pin a
+# whole worker process.
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', '8'))
+# Each open chat stream holds one of those threads. At most half of them serve
+# streams, so with the defaults 4 workers * 4 = 16 chat tabs get live updates;
+# further tabs poll every CHAT_STREAM_BUSY_RETRY seconds instead, and page
+# views always have the other threads.
+os.environ.setdefault('CHAT_STREAMS_PER_PROCESS', str(max(1, threads // 2)))
+# Import the app (and compile its templates) once in the master; workers fork
+# from it and share the compiled templates copy-on-write.
+preload_app = True
+
+
+def on_starting(server):
+    # Metrics snapshots left by a previous run would otherwise be summed into this one.
+    from main import reset_metrics
+    reset_metrics()
+
+
+def post_fork(server, worker):
+    # Connections opened in the master must not be shared with forked workers.
+    from main import app, db
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+
+def post_worker_init(worker):
+    # Migrations are applied by `flask db-upgrade`; a worker only checks that the
+    # schema is current, which costs one query no matter how much data there is.
+    from main import app, check_schema, job_runner
+    with app.app_context():
+        check_schema()
+    # Background job threads run in every worker; see JobRunner.
+    job_runner.start()
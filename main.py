@@ -1,16 +1,224 @@
 
-from flask import Flask, render_template_string, request, redirect, url_for, flash
+from flask import (Flask, before_render_template, template_rendered, render_template, stream_template, request, redirect, url_for, flash, abort, g, has_request_context,
+                   Response, stream_with_context, session, make_response, send_from_directory)
+from markupsafe import Markup, escape
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, bindparam
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
+from werkzeug.exceptions import HTTPException
+from PIL import Image, ImageOps, UnidentifiedImageError
+try:
+    import brotli
+except ImportError:  # Assets are then precompressed with gzip only.
+    brotli = None
+from collections import namedtuple, Counter, OrderedDict
 import os
-from datetime import datetime
+import time
+import atexit
+import threading
+import re
+import json
+import math
+import logging
+import hashlib
+import hmac
+import gzip
+import zlib
+import sqlite3
+import socket
+import traceback
+from functools import wraps
+import base64
+import binascii
+import click
+import tempfile
+import shutil
+import subprocess
+import sys
+import random
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+# Database configuration
+def database_url():
+    url = os.environ.get('DATABASE_URL', 'sqlite:///forum.db')
+    # Hosting providers still hand out the scheme SQLAlchemy 1.4 dropped.
+    if url.startswith('postgres://'):
+        url = 'postgresql://' + url[len('postgres://'):]
+    return url
+
+def engine_options(url):
+    """Pool settings for the configured database; in-memory SQLite keeps its static pool."""
+    if url.startswith('sqlite') and (url in ('sqlite://', 'sqlite:///:memory:') or 'mode=memory' in url):
+        return {}
+    return {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 10)),
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': not url.startswith('sqlite'),
+    }
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your_secret_key'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///forum.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = database_url()
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
+# Applied to every new SQLite connection. WAL lets readers proceed while a writer
+# commits, and busy_timeout makes writers from other workers wait instead of
+# failing with "database is locked".
+app.config['SQLITE_PRAGMAS'] = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000)),
+    'mmap_size': int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+}
 app.config['UPLOAD_FOLDER'] = 'static/uploads'
+# Avatars are stored by content hash, resized once at upload to every size the
+# templates draw them at, and served as immutable files.
+app.config['AVATAR_FOLDER'] = os.path.join(app.config['UPLOAD_FOLDER'], 'avatars')
+app.config['AVATAR_MAX_BYTES'] = 2 * 1024 * 1024
+# A small, well-compressed file can still decode to a huge bitmap, so the pixel
+# count is capped too; a phone photo fits.
+app.config['AVATAR_MAX_PIXELS'] = 12 * 1000 * 1000
+app.config['AVATAR_SIZES'] = (30, 40, 50, 120)
+app.config['AVATAR_MAX_AGE'] = 365 * 24 * 3600
+# CSS and JavaScript under static/ are served from /assets under names that
+# include a hash of their content, precompressed once at startup.
+app.config['ASSET_MAX_AGE'] = 365 * 24 * 3600
+# Dynamic responses of these types are gzipped when the client accepts it and
+# the body is at least COMPRESS_MIN_BYTES; streamed bodies are compressed as
+# they are sent.
+app.config['COMPRESS_ENABLED'] = True
+app.config['COMPRESS_MIN_BYTES'] = 1024
+app.config['COMPRESS_LEVEL'] = 6
+app.config['COMPRESS_MIMETYPES'] = {'text/html', 'application/json', 'text/plain'}
+# Werkzeug answers 413 to larger request bodies before the view runs.
+app.config['MAX_CONTENT_LENGTH'] = 4 * 1024 * 1024
+app.config['FORUM_PAGE_SIZE'] = 25
+app.config['FORUM_MAX_PAGE_SIZE'] = 100
+app.config['SEARCH_PAGE_SIZE'] = 20
+app.config['CHAT_PAGE_SIZE'] = 50
+app.config['CHAT_MAX_PAGE_SIZE'] = 200
+# Replies per page of /api/v1/threads/<id>; the HTML page shows them all.
+app.config['API_POSTS_PAGE_SIZE'] = 50
+app.config['API_POSTS_MAX_PAGE_SIZE'] = 200
+# Threads with at least this many replies are streamed: replies are fetched in
+# batches from a server-side cursor while the page is being sent, so the first
+# bytes go out at once and memory does not grow with the thread. Streamed pages
+# bypass the anonymous page cache.
+app.config['THREAD_STREAM_MIN_REPLIES'] = 200
+app.config['THREAD_STREAM_BATCH_SIZE'] = 100
+app.config['THREAD_STREAM_CHUNK_BYTES'] = 16 * 1024
+# Thread views are buffered per process and written in batches; at most one
+# interval's worth of views is lost if a worker dies.
+app.config['VIEW_FLUSH_INTERVAL'] = 5
+app.config['VIEW_FLUSH_THRESHOLD'] = 500
+# /forum?sort=hot ranks threads by points that halve every HOT_HALF_LIFE seconds.
+# Each view, reply and new thread adds its weight scaled to a shared anchor time,
+# so nothing has to be rewritten as time passes; every HOT_DECAY_INTERVAL seconds
+# the anchor is moved to the present and all scores are rescaled once, which
+# keeps the stored numbers in range.
+app.config['HOT_HALF_LIFE'] = 24 * 3600
+app.config['HOT_DECAY_INTERVAL'] = 3600
+app.config['HOT_VIEW_WEIGHT'] = 1.0
+app.config['HOT_POST_WEIGHT'] = 20.0
+app.config['HOT_THREAD_WEIGHT'] = 20.0
+# Background jobs are rows in the job table, claimed by JOB_WORKERS threads in each
+# worker process. A job that raises is retried after JOB_RETRY_DELAY seconds,
+# doubling each time up to JOB_RETRY_MAX_DELAY, until it has run JOB_MAX_ATTEMPTS
+# times; one still running after JOB_TIMEOUT is presumed lost with its process and
+# queued again. Periodic jobs are enqueued by whichever process holds the
+# scheduler lease, which it renews every JOB_SCHEDULER_INTERVAL seconds.
+app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', 2))
+app.config['JOB_POLL_INTERVAL'] = 1.0
+app.config['JOB_MAX_ATTEMPTS'] = 5
+app.config['JOB_RETRY_DELAY'] = 10
+app.config['JOB_RETRY_MAX_DELAY'] = 3600
+app.config['JOB_TIMEOUT'] = 600
+app.config['JOB_SCHEDULER_INTERVAL'] = 5
+app.config['JOB_LEASE_SECONDS'] = 30
+app.config['JOB_PRUNE_INTERVAL'] = 3600
+app.config['JOB_KEEP_FINISHED'] = 7 * 24 * 3600
+# Chat streams wait for a notification instead of polling; one watcher thread per
+# process picks up messages stored by other workers every poll interval.
+app.config['CHAT_NOTIFIER_POLL_INTERVAL'] = 1.0
+app.config['CHAT_NOTIFIER_KEEP_SECONDS'] = 60
+app.config['CHAT_STREAM_HEARTBEAT'] = 15
+app.config['CHAT_STREAM_MAX_SECONDS'] = 300
+# An open stream holds a request thread for up to CHAT_STREAM_MAX_SECONDS, so each
+# process keeps at most this many open and the rest of its threads for pages.
+# Past the cap a stream sends what is new and closes, and the browser reconnects
+# after CHAT_STREAM_BUSY_RETRY seconds, i.e. it polls. The deployment serves
+# workers * CHAT_STREAMS_PER_PROCESS live streams (see gunicorn.conf.py).
+app.config['CHAT_STREAMS_PER_PROCESS'] = int(os.environ.get('CHAT_STREAMS_PER_PROCESS', 4))
+app.config['CHAT_STREAM_BUSY_RETRY'] = 20
+# Navbar unread badge: cached per process, adjusted in place by this process's
+# own sends and reads, and recounted after the TTL.
+app.config['UNREAD_COUNT_TTL'] = 30
+app.config['UNREAD_COUNT_MAX_ENTRIES'] = 10000
+# Logged-in users are loaded from a per-process cache; profile edits made in
+# another worker reach this one within the TTL.
+app.config['USER_CACHE_TTL'] = 60
+app.config['USER_CACHE_MAX_ENTRIES'] = 10000
+# Rendered pages for logged-out visitors are shared by all workers through a
+# local SQLite file and dropped as soon as a write changes what they show; the
+# TTL only bounds how stale view counts can get.
+app.config['PAGE_CACHE_ENABLED'] = True
+app.config['PAGE_CACHE_PATH'] = os.environ.get('PAGE_CACHE_PATH', os.path.join(app.instance_path, 'page_cache.db'))
+app.config['PAGE_CACHE_TTL'] = 60
+app.config['PAGE_CACHE_MAX_ENTRY_BYTES'] = 8 * 1024 * 1024
+# Past this total, storing a page evicts the entries closest to expiry.
+app.config['PAGE_CACHE_MAX_BYTES'] = 256 * 1024 * 1024
+# Expired entries and invalidation records older than this are deleted by each
+# process that writes to the cache, at most once per interval, so every host
+# prunes its own file; no render may take longer.
+app.config['PAGE_CACHE_PRUNE_INTERVAL'] = 600
+# Password hashes are computed on a small per-process pool so that a burst of
+# logins cannot occupy every request thread; when PASSWORD_HASH_QUEUE hashes are
+# already waiting or running, further logins get a 503 at once. Hashes made with
+# a different method are upgraded on the user's next successful login.
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+app.config['PASSWORD_HASH_QUEUE'] = int(os.environ.get('PASSWORD_HASH_QUEUE', 8))
+# Every request is logged as one JSON line with its SQL, render and total time,
+# which are also sent to the browser in a Server-Timing header. Requests and
+# statements over these thresholds are logged as warnings with the SQL involved.
+app.config['SERVER_TIMING_ENABLED'] = True
+app.config['SLOW_REQUEST_MS'] = float(os.environ.get('SLOW_REQUEST_MS', 500))
+app.config['SLOW_QUERY_MS'] = float(os.environ.get('SLOW_QUERY_MS', 100))
+# /metrics sums the snapshots every worker writes to METRICS_DIR (one JSON file
+# per pid, rewritten at most every METRICS_WRITE_INTERVAL seconds while it serves
+# requests, so a scrape lags other workers by no more than that). gunicorn
+# empties the directory when the master starts.
+app.config['METRICS_DIR'] = os.environ.get('METRICS_DIR', os.path.join(app.instance_path, 'metrics'))
+app.config['METRICS_WRITE_INTERVAL'] = 1.0
+app.config['METRICS_LATENCY_BUCKETS'] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# /metrics and /internal/stats. With STATS_TOKEN set they require the header
+# `Authorization: Bearer <token>`. Without it they answer only direct connections
+# from STATS_ALLOWED_ADDRS: a reverse proxy on the same host makes every client
+# look local, so requests carrying a forwarding header are refused. Set the token
+# (or deny these paths at the proxy) whenever a proxy is in front.
+app.config['STATS_TOKEN'] = os.environ.get('STATS_TOKEN')
+app.config['STATS_ALLOWED_ADDRS'] = {'127.0.0.1', '::1'}
+# Upper bound on SQL statements per GET request, by endpoint. Exceeding it is logged
+# and fails `flask check-sql-budgets`, so N+1 lazy loads cannot creep back in. The
+# counts are for a worker whose user and unread caches are cold.
+app.config['SQL_STATEMENT_BUDGETS'] = {
+    'forum': 3,
+    'thread': 4,
+    'user_profile': 5,
+    'chat': 6,
+    'chat_older': 3,
+    'inbox': 3,
+    'search': 2,
+    'api_threads': 2,
+    'api_thread': 2,
+    'api_chat': 5,
+}
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
 db = SQLAlchemy(app)
@@ -21,11 +229,11 @@ login_manager.login_view = 'login'
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(150), unique=True, nullable=False)
-    password_hash = db.Column(db.String(150), nullable=False)
+    password_hash = db.Column(db.String(255), nullable=False)
     bio = db.Column(db.Text)
     profile_pic = db.Column(db.String(150), default='default.jpg')
     join_date = db.Column(db.DateTime, default=datetime.utcnow)
-    threads = db.relationship('Thread', backref='author', lazy=True)
+    threads = db.relationship('Thread', backref='author', lazy=True, foreign_keys='Thread.user_id')
     posts = db.relationship('Post', backref='author', lazy=True)
 
 class Thread(db.Model):
@@ -37,6 +245,21 @@ class Thread(db.Model):
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     posts = db.relationship('Post', backref='thread', lazy=True, cascade='all, delete-orphan')
     views = db.Column(db.Integer, default=0)
+    # render_body(content), stored when the row is written; see `flask backfill-body-html`.
+    content_html = db.Column(db.Text)
+    # Denormalized from Post so listings never have to touch the post table;
+    # kept in step by thread() and repaired by `flask rebuild-thread-counters`.
+    reply_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    last_post_at = db.Column(db.DateTime)
+    last_post_user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    last_poster = db.relationship('User', foreign_keys=[last_post_user_id])
+    # Relative to the anchor in app_state; only comparable between threads. See hot_points().
+    hot_score = db.Column(db.Float, nullable=False, default=0, server_default='0')
+    __table_args__ = (
+        db.Index('ix_thread_updated_at_id', 'updated_at', 'id'),
+        db.Index('ix_thread_user_id_created_at', 'user_id', 'created_at'),
+        db.Index('ix_thread_hot_score_id', 'hot_score', 'id'),
+    )
 
 class Post(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -44,6 +267,11 @@ class Post(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     thread_id = db.Column(db.Integer, db.ForeignKey('thread.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    content_html = db.Column(db.Text)
+    __table_args__ = (
+        db.Index('ix_post_thread_id_created_at_id', 'thread_id', 'created_at', 'id'),
+        db.Index('ix_post_user_id_created_at', 'user_id', 'created_at'),
+    )
 
 class Message(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -52,342 +280,1813 @@ class Message(db.Model):
     receiver_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     is_read = db.Column(db.Boolean, default=False)
+    content_html = db.Column(db.Text)
+    __table_args__ = (
+        # Serves both directions of a conversation: each side of chat()'s OR
+        # filter is an equality on (sender_id, receiver_id).
+        db.Index('ix_message_conversation', 'sender_id', 'receiver_id', 'created_at', 'id'),
+        # Only unread rows are indexed, so marking a conversation read stays cheap
+        # however long its history is. Queries must spell the filter as
+        # `is_read == db.false()` for the planner to match this predicate.
+        db.Index('ix_message_unread', 'receiver_id', 'sender_id',
+                 sqlite_where=db.text('is_read = 0'), postgresql_where=db.text('NOT is_read')),
+        # The received side of the inbox query.
+        db.Index('ix_message_receiver', 'receiver_id', 'created_at', 'id'),
+    )
+
+class Job(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(64), nullable=False)
+    # JSON object of keyword arguments for the job function.
+    payload = db.Column(db.Text, nullable=False, default='{}')
+    # queued -> running -> done, or back to queued for a retry, or failed.
+    state = db.Column(db.String(16), nullable=False, default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    # host:pid of the process running it.
+    locked_by = db.Column(db.String(64))
+    last_error = db.Column(db.Text)
+    __table_args__ = (
+        # Claiming reads the first queued row by run_at; the job CLI counts by state.
+        db.Index('ix_job_state_run_at_id', 'state', 'run_at', 'id'),
+    )
+
+# Named leases on cluster-wide roles, such as scheduling periodic jobs.
+job_lease = db.Table('job_lease', db.Column('name', db.String(64), primary_key=True),
+                     db.Column('holder', db.String(64), nullable=False),
+                     db.Column('expires_at', db.DateTime, nullable=False))
+
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in app.config['SQLITE_PRAGMAS'].items():
+        cursor.execute(f'PRAGMA {name} = {value}')
+    cursor.close()
+
+with app.app_context():
+    if db.engine.dialect.name == 'sqlite':
+        event.listen(db.engine, 'connect', apply_sqlite_pragmas)
+
+# Per-request instrumentation
+request_logger = logging.getLogger('mahkeme.requests')
+if not request_logger.handlers:
+    request_logger.addHandler(logging.StreamHandler())
+    request_logger.setLevel(logging.INFO)
+    request_logger.propagate = False
+
+class RequestTiming:
+    """Where one request spent its time. Kept in ``g.timing``."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.db_seconds = 0.0
+        self.render_seconds = 0.0
+        self.queries = []  # (seconds, statement), for the slow-request log
+        self._render_started = []
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self.started) * 1000
+
+    def server_timing(self):
+        return (f'db;dur={self.db_seconds * 1000:.1f};desc="{self.statements} queries", '
+                f'render;dur={self.render_seconds * 1000:.1f}, total;dur={self.elapsed_ms():.1f}')
+
+def current_timing():
+    return g.get('timing') if has_request_context() else None
+
+with app.app_context():
+    @event.listens_for(db.engine, 'before_cursor_execute')
+    def start_statement_timer(conn, cursor, statement, parameters, context, executemany):
+        # Kept on the execution context, which is discarded with the statement
+        # even when it raises and after_cursor_execute never fires.
+        context._query_start_time = time.perf_counter()
+
+    @event.listens_for(db.engine, 'after_cursor_execute')
+    def stop_statement_timer(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - context._query_start_time
+        timing = current_timing()
+        if timing is not None:
+            timing.statements += 1
+            timing.db_seconds += elapsed
+            timing.queries.append((elapsed, statement))
+        if timing is not None and elapsed * 1000 >= app.config['SLOW_QUERY_MS']:
+            app.logger.warning('Slow query (%.1f ms) in %s: %s', elapsed * 1000, request.endpoint, statement)
+
+@before_render_template.connect_via(app)
+def start_render_timer(sender, template, context, **extra):
+    timing = current_timing()
+    if timing is not None:
+        timing._render_started.append(time.perf_counter())
+
+@template_rendered.connect_via(app)
+def stop_render_timer(sender, template, context, **extra):
+    timing = current_timing()
+    if timing is not None and timing._render_started:
+        timing.render_seconds += time.perf_counter() - timing._render_started.pop()
+
+@app.before_request
+def start_request_timer():
+    g.timing = RequestTiming()
+
+@app.after_request
+def check_sql_budget(response):
+    budget = app.config['SQL_STATEMENT_BUDGETS'].get(request.endpoint)
+    count = g.timing.statements
+    if request.method == 'GET' and budget is not None and count > budget:
+        app.logger.warning('%s ran %d SQL statements (budget %d)', request.endpoint, count, budget)
+    return response
+
+@app.after_request
+def report_request_timing(response):
+    timing = g.timing
+    if app.config['SERVER_TIMING_ENABLED']:
+        response.headers['Server-Timing'] = timing.server_timing()
+    fields = {'method': request.method, 'path': request.full_path.rstrip('?'), 'endpoint': request.endpoint,
+              'status': response.status_code, 'pid': os.getpid()}
+    # Logged once the body has been sent, so streamed pages report their full time.
+    response.call_on_close(lambda: log_request(timing, fields))
+    return response
+
+def log_request(timing, fields):
+    total_ms = timing.elapsed_ms()
+    metrics.observe(fields['endpoint'], fields['method'], fields['status'], total_ms / 1000)
+    line = dict(fields, total_ms=round(total_ms, 1), db_ms=round(timing.db_seconds * 1000, 1),
+                db_statements=timing.statements, render_ms=round(timing.render_seconds * 1000, 1))
+    if total_ms >= app.config['SLOW_REQUEST_MS']:
+        line['slowest_queries'] = [{'ms': round(seconds * 1000, 1), 'sql': statement}
+                                   for seconds, statement in sorted(timing.queries, reverse=True)[:5]]
+        request_logger.warning(json.dumps(line, ensure_ascii=False))
+    else:
+        request_logger.info(json.dumps(line, ensure_ascii=False))
+
+# Keyset pagination helpers
+Page = namedtuple('Page', ['items', 'next_cursor', 'prev_cursor'])
+
+def encode_cursor(*values):
+    raw = json.dumps([v.isoformat() if isinstance(v, datetime) else v for v in values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_cursor(token, *types):
+    """Decode a cursor produced by encode_cursor, or return None if it is malformed."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        values = tuple(datetime.fromisoformat(v) if t is datetime else t(v)
+                       for t, v in zip(types, values, strict=True))
+    except (ValueError, TypeError, binascii.Error):
+        return None
+    if any(isinstance(v, float) and not math.isfinite(v) for v in values):
+        return None
+    return values
+
+def requested_thread_sort():
+    sort = request.args.get('sort') or 'recent'
+    if sort not in ('recent', 'hot'):
+        abort(400)
+    return sort
+
+def requested_thread_cursors(sort='recent'):
+    """The decoded ``after`` or ``before`` listing cursor of this request; 400 if malformed."""
+    types = (float, int, float) if sort == 'hot' else (datetime, int)
+    after = before = None
+    if request.args.get('after'):
+        after = decode_cursor(request.args['after'], *types) or abort(400)
+    elif request.args.get('before'):
+        before = decode_cursor(request.args['before'], *types) or abort(400)
+    return after, before
+
+def requested_page_size(default_key, max_key):
+    per_page = request.args.get('per_page', type=int) or app.config[default_key]
+    return max(1, min(per_page, app.config[max_key]))
+
+def rescale_hot_cursor(cursor, anchor):
+    """Measure a decoded hot cursor against ``anchor``; 400 if its anchor is too far off to rescale."""
+    try:
+        score = cursor[0] * 2 ** ((cursor[2] - anchor) / app.config['HOT_HALF_LIFE'])
+    except OverflowError:
+        abort(400)
+    if not math.isfinite(score):
+        abort(400)
+    return score, cursor[1]
+
+def paginate_threads(query, after=None, before=None, per_page=25, sort='recent'):
+    """Return one page of threads ordered by (updated_at, id), or (hot_score, id) for sort='hot', descending.
+
+    ``after`` and ``before`` are decoded cursors; only one is used. Each page is a
+    single indexed range read, so its cost does not depend on how deep into the
+    listing it is. Hot cursors also carry the anchor their score was measured
+    against, so paging continues in place after decay_hot_scores() rescales.
+    """
+    if sort == 'hot':
+        column, anchor = Thread.hot_score, hot_anchor()
+        after, before = (cursor and rescale_hot_cursor(cursor, anchor) for cursor in (after, before))
+        cursor_of = lambda thread: encode_cursor(thread.hot_score, thread.id, anchor)
+    else:
+        column = Thread.updated_at
+        cursor_of = lambda thread: encode_cursor(thread.updated_at, thread.id)
+    key = db.tuple_(column, Thread.id)
+    if before:
+        query = query.filter(key > before).order_by(column.asc(), Thread.id.asc())
+    else:
+        if after:
+            query = query.filter(key < after)
+        query = query.order_by(column.desc(), Thread.id.desc())
+    rows = query.limit(per_page + 1).all()
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if before:
+        rows.reverse()
+    has_next = has_more if not before else True
+    has_prev = bool(after) if not before else has_more
+    next_cursor = cursor_of(rows[-1]) if rows and has_next else None
+    prev_cursor = cursor_of(rows[0]) if rows and has_prev else None
+    return Page(rows, next_cursor, prev_cursor)
+
+def chat_history_page(me, peer, before=None, per_page=50):
+    """Return the newest messages between two users older than the ``before`` cursor.
+
+    Each direction of the conversation is read as its own index range, newest
+    first and limited to one page, and the two are merged. The cost is bounded by
+    the page size rather than the length of the conversation. ``prev_cursor``
+    points at the next older page.
+    """
+    def newest(sender_id, receiver_id):
+        query = db.select(Message.id).where(Message.sender_id == sender_id, Message.receiver_id == receiver_id)
+        if before:
+            query = query.where(db.tuple_(Message.created_at, Message.id) < before)
+        query = query.order_by(Message.created_at.desc(), Message.id.desc()).limit(per_page + 1)
+        return db.select(query.subquery().c.id)
+    ids = db.union_all(newest(me, peer), newest(peer, me)).subquery()
+    rows = (Message.query.filter(Message.id.in_(db.select(ids.c.id)))
+            .order_by(Message.created_at.desc(), Message.id.desc()).limit(per_page + 1).all())
+    has_older = len(rows) > per_page
+    rows = rows[:per_page][::-1]
+    prev_cursor = encode_cursor(rows[0].created_at, rows[0].id) if rows and has_older else None
+    return Page(rows, None, prev_cursor)
+
+def thread_posts_page(thread_id, after=None, per_page=50):
+    """Return the replies of a thread after the ``after`` (created_at, id) cursor, oldest first."""
+    query = Post.query.options(joinedload(Post.author)).filter(Post.thread_id == thread_id)
+    if after:
+        query = query.filter(db.tuple_(Post.created_at, Post.id) > after)
+    rows = query.order_by(Post.created_at.asc(), Post.id.asc()).limit(per_page + 1).all()
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    next_cursor = encode_cursor(rows[-1].created_at, rows[-1].id) if rows and has_more else None
+    return Page(rows, next_cursor, None)
+
+def conversation_state(me, peer):
+    """(id, created_at) of the newest message between two users and how many of me's messages peer has not read.
+
+    Both change whenever what chat_history_page() would return does, so together
+    they validate a cached copy of a conversation. The id is None if there are no
+    messages yet.
+    """
+    def newest(sender_id, receiver_id):
+        query = (db.select(Message.id, Message.created_at)
+                 .where(Message.sender_id == sender_id, Message.receiver_id == receiver_id)
+                 .order_by(Message.created_at.desc(), Message.id.desc()).limit(1)).subquery()
+        return db.select(query.c.id, query.c.created_at)
+    latest = db.union_all(newest(me, peer), newest(peer, me)).subquery()
+    unread_by_peer = (db.select(db.func.count()).select_from(Message)
+                      .where(Message.receiver_id == peer, Message.sender_id == me, Message.is_read == db.false())
+                      .scalar_subquery())
+    row = db.session.execute(
+        db.select(latest.c.id, latest.c.created_at, unread_by_peer)
+        .order_by(latest.c.created_at.desc(), latest.c.id.desc()).limit(1)).first()
+    return tuple(row) if row else (None, None, 0)
+
+# Per-process caches
+class TTLCache:
+    """A thread-safe LRU cache whose entries expire after a TTL.
+
+    Size and lifetime are read from the config keys given, so they can be tuned
+    without touching the code. Hit and miss counts are kept for CACHES reporting.
+    """
+
+    def __init__(self, ttl_key, max_entries_key):
+        self.ttl_key = ttl_key
+        self.max_entries_key = max_entries_key
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key, load):
+        """Return the cached value for key, calling load(key) on a miss; None is not cached."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        value = load(key)
+        if value is not None:
+            with self._lock:
+                self._entries[key] = (value, now + app.config[self.ttl_key])
+                self._entries.move_to_end(key)
+                while len(self._entries) > app.config[self.max_entries_key]:
+                    self._entries.popitem(last=False)
+        return value
+
+    def update(self, key, func):
+        """Replace a cached value with func(value), keeping its expiry; no-op if absent."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                self._entries[key] = (func(entry[0]), entry[1])
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else None}
+
+# Named caches whose statistics are exposed by /internal/stats.
+CACHES = {}
+
+class CachedUser(UserMixin):
+    """The columns of User that request handling reads, detached from any session.
+
+    Views that change a user must load the User row itself; this object is shared
+    between requests.
+    """
+
+    def __init__(self, id, username, profile_pic):
+        self.id = id
+        self.username = username
+        self.profile_pic = profile_pic
+
+user_cache = CACHES['users'] = TTLCache('USER_CACHE_TTL', 'USER_CACHE_MAX_ENTRIES')
+
+def load_cached_user(user_id):
+    row = db.session.query(User.id, User.username, User.profile_pic).filter(User.id == user_id).first()
+    return CachedUser(*row) if row else None
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return user_cache.get(int(user_id), load_cached_user)
 
-# Reset database to ensure schema consistency
-with app.app_context():
-    db.drop_all()
-    db.create_all()
-
-# Base template components (header and footer)
-BASE_HEADER = '''
-<!DOCTYPE html>
-<html lang="tr">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>{% block title %}MAHKEME Forum{% endblock %}</title>
-    <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.1.3/dist/css/bootstrap.min.css" rel="stylesheet">
-    <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0-beta3/css/all.min.css">
-    <style>
-        :root {
-            --primary-color: #ff9500;
-            --secondary-color: #343a40;
-            --accent-color: #ff5555;
-            --light-bg: #f8f9fa;
-            --dark-bg: #212529;
-            --card-bg: #2d3035;
-            --text-light: #f8f9fa;
-            --text-dark: #212529;
-        }
-        body {
-            background-color: #121212;
-            color: #e0e0e0;
-            font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-            padding-top: 80px;
-            min-height: 100vh;
-        }
-        .forum-container {
-            background-color: var(--card-bg);
-            border-radius: 8px;
-            box-shadow: 0 4px 12px rgba(0, 0, 0, 0.15);
-            padding: 25px;
-            margin-bottom: 20px;
-        }
-        .thread-card, .post-card {
-            background-color: rgba(255, 255, 255, 0.05);
-            border: 1px solid rgba(255, 149, 0, 0.2);
-            border-radius: 6px;
-            padding: 15px;
-            margin-bottom: 15px;
-            transition: all 0.3s ease;
-        }
-        .thread-card:hover, .post-card:hover {
-            transform: translateY(-3px);
-            box-shadow: 0 6px 15px rgba(255, 149, 0, 0.25);
-            border-color: var(--primary-color);
-        }
-        .btn-primary {
-            background-color: var(--primary-color);
-            border-color: var(--primary-color);
-        }
-        .btn-primary:hover {
-            background-color: #e68500;
-            border-color: #e68500;
-        }
-        .text-primary {
-            color: var(--primary-color) !important;
-        }
-        a {
-            color: var(--primary-color);
-            text-decoration: none;
-            transition: color 0.2s;
-        }
-        a:hover {
-            color: #ffaa33;
-        }
-        .navbar-brand {
-            font-weight: bold;
-            font-size: 1.5rem;
-        }
-        .user-avatar {
-            width: 40px;
-            height: 40px;
-            border-radius: 50%;
-            object-fit: cover;
-            border: 2px solid var(--primary-color);
-        }
-        .thread-title {
-            font-size: 1.4rem;
-            font-weight: 600;
-            margin-bottom: 10px;
-        }
-        .thread-meta, .post-meta {
-            font-size: 0.85rem;
-            color: #adb5bd;
-        }
-        .badge-custom {
-            background-color: var(--primary-color);
-            color: var(--text-dark);
-        }
-        .form-control {
-            background-color: #2c2f36;
-            border: 1px solid #444;
-            color: #e0e0e0;
-        }
-        .form-control:focus {
-            background-color: #2c2f36;
-            border-color: var(--primary-color);
-            color: #e0e0e0;
-            box-shadow: 0 0 0 0.25rem rgba(255, 149, 0, 0.25);
-        }
-        .intro-text {
-            font-family: 'Courier New', monospace;
-            color: #00ff00;
-            text-shadow: 0 0 10px #00ff00;
-            font-size: 1.2rem;
-            line-height: 1.6;
-        }
-        .profile-header {
-            background: linear-gradient(to right, #2d3035, #1a1a1a);
-            border-radius: 8px;
-            padding: 20px;
-            margin-bottom: 20px;
-        }
-        .profile-avatar {
-            width: 120px;
-            height: 120px;
-            border-radius: 50%;
-            object-fit: cover;
-            border: 3px solid var(--primary-color);
-            box-shadow: 0 0 15px rgba(255, 149, 0, 0.5);
-        }
-        .message-bubble {
-            max-width: 75%;
-            padding: 12px 16px;
-            border-radius: 18px;
-            margin-bottom: 10px;
-            position: relative;
-        }
-        .message-sent {
-            background-color: rgba(255, 149, 0, 0.2);
-            margin-left: auto;
-            border-bottom-right-radius: 4px;
-        }
-        .message-received {
-            background-color: rgba(52, 58, 64, 0.4);
-            margin-right: auto;
-            border-bottom-left-radius: 4px;
-        }
-        .floating-btn {
-            position: fixed;
-            bottom: 30px;
-            right: 30px;
-            width: 60px;
-            height: 60px;
-            border-radius: 50%;
-            background-color: var(--primary-color);
-            color: white;
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            box-shadow: 0 4px 12px rgba(0, 0, 0, 0.3);
-            z-index: 100;
-            font-size: 1.5rem;
-            transition: all 0.3s;
-        }
-        .floating-btn:hover {
-            transform: scale(1.1);
-            color: white;
-        }
-        .category-badge {
-            background: linear-gradient(45deg, #ff9500, #ff5555);
-            color: white;
-            padding: 5px 10px;
-            border-radius: 4px;
-            font-size: 0.8rem;
-            font-weight: 600;
-        }
-        footer {
-            background-color: var(--dark-bg);
-            padding: 30px 0;
-            margin-top: 40px;
-        }
-        .alert {
-            border: none;
-            border-radius: 8px;
-        }
-        .pagination .page-link {
-            background-color: var(--card-bg);
-            border-color: #444;
-            color: var(--primary-color);
-        }
-        .pagination .page-item.active .page-link {
-            background-color: var(--primary-color);
-            border-color: var(--primary-color);
-            color: var(--text-dark);
-        }
-        .chat-messages {
-            max-height: 400px;
-            overflow-y: auto;
-            padding: 10px;
-        }
-    </style>
-</head>
-<body>
-    <nav class="navbar navbar-expand-lg navbar-dark bg-dark fixed-top">
-        <div class="container">
-            <a class="navbar-brand" href="{{ url_for('forum') }}">
-                <i class="fas fa-fire"></i> MAHKEME Forum
-            </a>
-            <button class="navbar-toggler" type="button" data-bs-toggle="collapse" data-bs-target="#navbarNav">
-                <span class="navbar-toggler-icon"></span>
-            </button>
-            <div class="collapse navbar-collapse" id="navbarNav">
-                <ul class="navbar-nav me-auto">
-                    <li class="nav-item">
-                        <a class="nav-link" href="{{ url_for('forum') }}">Ana Sayfa</a>
-                    </li>
-                    <li class="nav-item">
-                        <a class="nav-link" href="#">Kategoriler</a>
-                    </li>
-                    <li class="nav-item">
-                        <a class="nav-link" href="#">Üyeler</a>
-                    </li>
-                </ul>
-                <ul class="navbar-nav ms-auto">
-                    {% if current_user.is_authenticated %}
-                    <li class="nav-item dropdown">
-                        <a class="nav-link dropdown-toggle" href="#" id="navbarDropdown" role="button" data-bs-toggle="dropdown">
-                            <img src="{{ url_for('static', filename='uploads/' + current_user.profile_pic) }}" width="30" height="30" class="rounded-circle me-2">
-                            {{ current_user.username }}
-                        </a>
-                        <div class="dropdown-menu dropdown-menu-end">
-                            <a class="dropdown-item" href="{{ url_for('user_profile', username=current_user.username) }}">Profilim</a>
-                            <a class="dropdown-item" href="{{ url_for('profile') }}">Profil Düzenle</a>
-                            <div class="dropdown-divider"></div>
-                            <a class="dropdown-item" href="{{ url_for('logout') }}">Çıkış</a>
-                        </div>
-                    </li>
-                    {% else %}
-                    <li class="nav-item">
-                        <a class="nav-link" href="{{ url_for('login') }}">Giriş</a>
-                    </li>
-                    <li class="nav-item">
-                        <a class="nav-link" href="{{ url_for('register') }}">Kayıt</a>
-                    </li>
-                    {% endif %}
-                </ul>
-            </div>
-        </div>
-    </nav>
-    <div class="container">
-        {% with messages = get_flashed_messages(with_categories=true) %}
-            {% if messages %}
-                {% for category, message in messages %}
-                    <div class="alert alert-{{ category }} alert-dismissible fade show" role="alert">
-                        {{ message }}
-                        <button type="button" class="btn-close" data-bs-dismiss="alert"></button>
-                    </div>
-                {% endfor %}
-            {% endif %}
-        {% endwith %}
+# Background jobs
+JobSpec = namedtuple('JobSpec', ['func', 'max_attempts', 'every'])
+
+JOBS = {}
+
+def job(name, max_attempts=None, every=None):
+    """Register a function as the job ``name``; it is called with the payload as keyword arguments.
+
+    ``every`` names a config key: the job is then also enqueued every that many
+    seconds. Jobs can run more than once (after a timeout, say), so they must be
+    safe to repeat.
+    """
+    def register(func):
+        JOBS[name] = JobSpec(func, max_attempts, every)
+        return func
+    return register
+
+def job_values(name, payload, delay=0):
+    if name not in JOBS:
+        raise KeyError(f'Unknown job {name!r}')
+    return {'name': name, 'payload': json.dumps(payload), 'state': 'queued', 'attempts': 0,
+            'max_attempts': JOBS[name].max_attempts or app.config['JOB_MAX_ATTEMPTS'],
+            'run_at': datetime.utcnow() + timedelta(seconds=delay), 'created_at': datetime.utcnow()}
+
+def enqueue(name, delay=0, **payload):
+    """Add a job to the current session. Workers see it once the session commits."""
+    queued = Job(**job_values(name, payload, delay))
+    db.session.add(queued)
+    db.session.info['jobs_enqueued'] = True
+    return queued
+
+@event.listens_for(db.session, 'after_commit')
+def wake_job_workers(session):
+    if session.info.pop('jobs_enqueued', False):
+        job_runner.wake()
+
+def retry_delay(attempts):
+    """Seconds to wait before running a job again after its ``attempts``-th failure."""
+    delay = min(app.config['JOB_RETRY_DELAY'] * 2 ** (attempts - 1), app.config['JOB_RETRY_MAX_DELAY'])
+    return delay * random.uniform(0.8, 1.2)
+
+def acquire_lease(name, holder, seconds):
+    """Take or renew the lease ``name``; True if ``holder`` now holds it for ``seconds``.
+
+    The lease row is read first, so processes that do not hold an unexpired
+    lease only ever take the write lock to claim it.
+    """
+    now = datetime.utcnow()
+    values = {'holder': holder, 'expires_at': now + timedelta(seconds=seconds)}
+    with db.engine.connect() as conn:
+        current = conn.execute(db.select(job_lease.c.holder, job_lease.c.expires_at)
+                               .where(job_lease.c.name == name)).first()
+    if current is not None:
+        if current.holder != holder and current.expires_at >= now:
+            return False
+        with db.engine.begin() as conn:
+            # Another process may have claimed it since the read.
+            return bool(conn.execute(job_lease.update().where(
+                job_lease.c.name == name, (job_lease.c.holder == holder) | (job_lease.c.expires_at < now)
+            ).values(**values)).rowcount)
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(job_lease.insert().values(name=name, **values))
+    except IntegrityError:
+        return False  # Held by someone else.
+    return True
+
+class JobRunner:
+    """Runs queued jobs on JOB_WORKERS threads in this process, and a scheduler thread.
+
+    A worker claims the oldest due job with a single ``UPDATE ... RETURNING``, so
+    two workers can never claim the same job. The scheduler thread of the process
+    holding the ``scheduler`` lease enqueues periodic jobs when they are due and
+    requeues jobs whose process died while running them.
+    """
+
+    def __init__(self):
+        self.completed = 0
+        self.retried = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition()
+        self._pid = None
+        self._stopping = False
+
+    def start(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        self._stopping = False
+        for number in range(app.config['JOB_WORKERS']):
+            threading.Thread(target=self._work, name=f'job-worker-{number}', daemon=True).start()
+        threading.Thread(target=self._schedule, name='job-scheduler', daemon=True).start()
+
+    @property
+    def identity(self):
+        return f'{socket.gethostname()}:{os.getpid()}'
+
+    def stop(self):
+        """Stop claiming jobs; ones already running finish if the process lives long enough."""
+        self._stopping = True
+        self.wake()
+
+    def wake(self):
+        with self._wakeup:
+            self._wakeup.notify_all()
+
+    def claim(self):
+        """Mark the oldest due job running and return it, or None if there is none."""
+        table = Job.__table__
+        now = datetime.utcnow()
+        due = (table.c.state == 'queued') & (table.c.run_at <= now)
+        with db.engine.connect() as conn:
+            # A plain read first, so that idle workers do not queue for the write lock.
+            if conn.execute(db.select(table.c.id).where(due).limit(1)).first() is None:
+                return None
+        first = (db.select(table.c.id).where(due).order_by(table.c.run_at, table.c.id).limit(1)
+                 .with_for_update(skip_locked=True).scalar_subquery())
+        with db.engine.begin() as conn:
+            return conn.execute(
+                db.update(table).where(table.c.id == first, table.c.state == 'queued')
+                .values(state='running', attempts=table.c.attempts + 1, started_at=now, locked_by=self.identity)
+                .returning(table.c.id, table.c.name, table.c.payload, table.c.attempts, table.c.max_attempts)).first()
+
+    def run(self, claimed):
+        """Run a claimed job and record the outcome: done, queued for a retry, or failed."""
+        table = Job.__table__
+        started = time.perf_counter()
+        try:
+            JOBS[claimed.name].func(**json.loads(claimed.payload))
+        except Exception:
+            app.logger.exception('Job %s #%d failed (attempt %d of %d)', claimed.name, claimed.id,
+                                 claimed.attempts, claimed.max_attempts)
+            db.session.rollback()
+            error = traceback.format_exc()[-4000:]
+            if claimed.attempts >= claimed.max_attempts:
+                values = {'state': 'failed', 'finished_at': datetime.utcnow()}
+                self.failed += 1
+            else:
+                values = {'state': 'queued', 'run_at': datetime.utcnow() + timedelta(seconds=retry_delay(claimed.attempts))}
+                self.retried += 1
+            values.update(last_error=error, locked_by=None)
+        else:
+            values = {'state': 'done', 'finished_at': datetime.utcnow(), 'locked_by': None}
+            self.completed += 1
+        with db.engine.begin() as conn:
+            conn.execute(db.update(table).where(table.c.id == claimed.id).values(**values))
+        app.logger.info('Job %s #%d %s in %.1f ms', claimed.name, claimed.id, values['state'],
+                        (time.perf_counter() - started) * 1000)
+
+    def run_pending(self):
+        """Run due jobs in the calling thread until there are none; returns how many ran."""
+        ran = 0
+        while (claimed := self.claim()) is not None:
+            with app.app_context():
+                self.run(claimed)
+            ran += 1
+        return ran
+
+    def schedule(self):
+        """Enqueue periodic jobs that are due and requeue lost ones, if this process holds the lease."""
+        if not acquire_lease('scheduler', self.identity, app.config['JOB_LEASE_SECONDS']):
+            return False
+        table = Job.__table__
+        now = time.time()
+        for name, spec in JOBS.items():
+            if spec.every is None:
+                continue
+            key = f'next_run:{name}'
+            with db.engine.begin() as conn:
+                next_run = conn.execute(db.select(app_state.c.value).where(app_state.c.key == key)).scalar()
+                if next_run is not None and next_run > now:
+                    continue
+                # One instance at a time: a backlog should not pile up copies of the same job.
+                pending = conn.execute(db.select(table.c.id).where(
+                    table.c.name == name, table.c.state.in_(('queued', 'running'))).limit(1)).first()
+                if pending is None:
+                    conn.execute(table.insert().values(**job_values(name, {})))
+                values = {'value': now + app.config[spec.every]}
+                if not conn.execute(app_state.update().where(app_state.c.key == key).values(**values)).rowcount:
+                    conn.execute(app_state.insert().values(key=key, **values))
+        lost = (table.c.state == 'running') & (
+            table.c.started_at < datetime.utcnow() - timedelta(seconds=app.config['JOB_TIMEOUT']))
+        with db.engine.begin() as conn:
+            conn.execute(db.update(table).where(lost, table.c.attempts >= table.c.max_attempts)
+                         .values(state='failed', finished_at=datetime.utcnow(), locked_by=None,
+                                 last_error='Timed out'))
+            conn.execute(db.update(table).where(lost).values(state='queued', run_at=datetime.utcnow(),
+                                                             locked_by=None, last_error='Timed out'))
+        self.wake()
+        return True
+
+    def stats(self):
+        return {'completed': self.completed, 'retried': self.retried, 'failed': self.failed}
+
+    def _work(self):
+        while not self._stopping:
+            try:
+                with app.app_context():
+                    claimed = self.claim()
+                    if claimed is not None:
+                        self.run(claimed)
+                        continue
+            except Exception:
+                app.logger.exception('Job worker error')
+            with self._wakeup:
+                self._wakeup.wait(app.config['JOB_POLL_INTERVAL'])
+
+    def _schedule(self):
+        while not self._stopping:
+            try:
+                with app.app_context():
+                    self.schedule()
+            except Exception:
+                app.logger.exception('Job scheduler error')
+            time.sleep(app.config['JOB_SCHEDULER_INTERVAL'])
+
+job_runner = JobRunner()
+atexit.register(job_runner.stop)
+
+@job('prune-jobs', every='JOB_PRUNE_INTERVAL')
+def prune_jobs():
+    """Delete finished jobs older than JOB_KEEP_FINISHED."""
+    cutoff = datetime.utcnow() - timedelta(seconds=app.config['JOB_KEEP_FINISHED'])
+    with db.engine.begin() as conn:
+        conn.execute(db.delete(Job.__table__).where(Job.state.in_(('done', 'failed')), Job.finished_at < cutoff))
+
+# Write-behind thread view counter
+class ViewCounter:
+    """Buffers thread view increments in memory and flushes them in batches.
+
+    A flush is one executemany of ``UPDATE thread SET views = views + ?`` (which also
+    adds them to hot_score), run when the buffer reaches ``VIEW_FLUSH_THRESHOLD``
+    views or every ``VIEW_FLUSH_INTERVAL`` seconds from a background thread, so page
+    views never take the write lock.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = Counter()
+        self._total = 0
+        self._pid = None
+
+    def record(self, thread_id):
+        with self._lock:
+            self._pending[thread_id] += 1
+            self._total += 1
+            due = self._total >= app.config['VIEW_FLUSH_THRESHOLD']
+        self._ensure_flusher()
+        if due:
+            self.flush()
+
+    def pending(self, thread_id):
+        return self._pending.get(thread_id, 0)
+
+    def flush(self):
+        with self._lock:
+            batch, self._pending, self._total = self._pending, Counter(), 0
+        if not batch:
+            return 0
+        table = Thread.__table__
+        stmt = (db.update(table).where(table.c.id == bindparam('thread_id'))
+                .values(views=table.c.views + bindparam('increment'),
+                        hot_score=table.c.hot_score + hot_increment(bindparam('increment') * app.config['HOT_VIEW_WEIGHT']),
+                        updated_at=table.c.updated_at))
+        try:
+            with app.app_context(), db.engine.begin() as conn:
+                conn.execute(stmt, [{'thread_id': k, 'increment': n} for k, n in batch.items()])
+        except Exception:
+            # Keep the views for the next attempt rather than dropping them.
+            with self._lock:
+                self._pending.update(batch)
+                self._total += sum(batch.values())
+            app.logger.exception('Flushing %d buffered thread views failed', len(batch))
+            return 0
+        return len(batch)
+
+    def _ensure_flusher(self):
+        # Started lazily so that each forked gunicorn worker runs its own thread.
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        threading.Thread(target=self._run, name='view-flusher', daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(app.config['VIEW_FLUSH_INTERVAL'])
+            self.flush()
+
+view_counter = ViewCounter()
+atexit.register(view_counter.flush)
+
+@app.template_global()
+def view_count(thread):
+    """Stored views plus the ones this process has not flushed yet."""
+    return (thread.views or 0) + view_counter.pending(thread.id)
+
+# Hot thread ranking
+# Small values shared by every process, one row per key.
+app_state = db.Table('app_state', db.Column('key', db.String(64), primary_key=True),
+                     db.Column('value', db.Float, nullable=False))
+
+def epoch(value):
+    """Seconds since the epoch of a naive UTC datetime."""
+    return value.replace(tzinfo=timezone.utc).timestamp()
+
+def hot_points(weight, at, anchor):
+    """``weight`` earned at ``at``, as stored in Thread.hot_score against ``anchor`` (both epoch seconds).
+
+    Points halve every HOT_HALF_LIFE seconds, so scaling them to one fixed anchor
+    keeps older and newer points comparable without ever revisiting them.
+    """
+    return weight * 2 ** ((at - anchor) / app.config['HOT_HALF_LIFE'])
+
+HOT_ANCHOR = db.select(app_state.c.value).where(app_state.c.key == 'hot_anchor')
+
+def stored_hot_anchor():
+    return HOT_ANCHOR.scalar_subquery()
+
+def hot_anchor():
+    return db.session.execute(HOT_ANCHOR).scalar()
+
+def hot_increment(weight):
+    """SQL for hot_points(weight, now, anchor), read against the anchor stored at the time it runs.
+
+    Reading the anchor in the same statement means an increment can never be
+    scaled for an anchor that decay_hot_scores() has just replaced.
+    """
+    return weight * db.func.power(2.0, (time.time() - stored_hot_anchor()) / app.config['HOT_HALF_LIFE'])
+
+@job('decay-hot-scores', every='HOT_DECAY_INTERVAL')
+def decay_hot_scores(now=None):
+    """Move the anchor to ``now`` and rescale every score to it, if it is HOT_DECAY_INTERVAL old.
+
+    Runs as a periodic job. A second run within the interval, say after a lost lease
+    was taken over, finds a fresh anchor and does nothing. Returns the number of
+    threads rescaled.
+    """
+    now = now or time.time()
+    table = Thread.__table__
+    due = stored_hot_anchor() <= now - app.config['HOT_DECAY_INTERVAL']
+    # The thread update comes first so that the write lock is held from the start;
+    # the anchor it reads is then the one the second statement replaces.
+    with db.engine.begin() as conn:
+        rescaled = conn.execute(
+            db.update(table).where(due)
+            .values(hot_score=table.c.hot_score * db.func.power(2.0, (stored_hot_anchor() - now) / app.config['HOT_HALF_LIFE']),
+                    updated_at=table.c.updated_at)).rowcount
+        conn.execute(app_state.update().where(app_state.c.key == 'hot_anchor', due).values(value=now))
+    return rescaled
+
+def rebuild_hot_scores(conn, thread_ids=None):
+    """Recompute Thread.hot_score from the thread's age, its reply times and its views.
+
+    Views carry no timestamps, so they count as of the thread's last activity.
+    Scores are computed against the stored anchor, which is created if missing.
+    Only columns that predate migration 8 are read, so it can run as part of it.
+    """
+    anchor = conn.execute(HOT_ANCHOR).scalar()
+    if anchor is None:
+        anchor = time.time()
+        conn.execute(app_state.insert().values(key='hot_anchor', value=anchor))
+    threads = db.select(Thread.id, Thread.created_at, Thread.views)
+    posts = db.select(Post.thread_id, Post.created_at)
+    if thread_ids is not None:
+        threads = threads.where(Thread.id.in_(thread_ids))
+        posts = posts.where(Post.thread_id.in_(thread_ids))
+    scores, views, last_activity = {}, {}, {}
+    for thread_id, created_at, thread_views in conn.execute(threads):
+        scores[thread_id] = hot_points(app.config['HOT_THREAD_WEIGHT'], epoch(created_at), anchor)
+        views[thread_id] = thread_views or 0
+        last_activity[thread_id] = epoch(created_at)
+    for thread_id, created_at in conn.execute(posts):
+        scores[thread_id] += hot_points(app.config['HOT_POST_WEIGHT'], epoch(created_at), anchor)
+        last_activity[thread_id] = max(last_activity[thread_id], epoch(created_at))
+    for thread_id in scores:
+        scores[thread_id] += hot_points(app.config['HOT_VIEW_WEIGHT'] * views[thread_id], last_activity[thread_id], anchor)
+    table = Thread.__table__
+    if scores:
+        conn.execute(db.update(table).where(table.c.id == bindparam('thread_id'))
+                     .values(hot_score=bindparam('score'), updated_at=table.c.updated_at),
+                     [{'thread_id': thread_id, 'score': score} for thread_id, score in scores.items()])
+    return len(scores)
+
+# Chat message notifications
+def conversation_key(user_a, user_b):
+    return (min(user_a, user_b), max(user_a, user_b))
+
+class MessageNotifier:
+    """Wakes waiting chat streams when a message is stored in their conversation.
+
+    chat() publishes the messages it inserts. A single watcher thread per process
+    reads new message ids (a primary-key range query) while streams are
+    subscribed, so messages sent through other gunicorn workers are noticed too.
+    While none are, it only moves its position to the newest id: a stream
+    subscribes before it catches up from the database, so nothing it skips can be
+    missed. Open streams block on a condition rather than each polling the
+    database. The newest id per conversation is kept for CHAT_NOTIFIER_KEEP_SECONDS
+    after it was published.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._subscribed = Counter()
+        self._latest = {}
+        self._pid = None
+
+    def publish(self, message_id, sender_id, receiver_id):
+        key = conversation_key(sender_id, receiver_id)
+        with self._cond:
+            if message_id > self._latest.get(key, (0, 0))[0]:
+                self._latest[key] = (message_id, time.monotonic())
+                if key in self._subscribed:
+                    self._cond.notify_all()
+
+    def subscribe(self, key):
+        """Start following a conversation; call before reading its messages, and unsubscribe() when done."""
+        self._ensure_watcher()
+        with self._cond:
+            self._subscribed[key] += 1
+
+    def unsubscribe(self, key):
+        with self._cond:
+            self._subscribed[key] -= 1
+            if not self._subscribed[key]:
+                del self._subscribed[key]
+
+    def wait(self, key, after_id, timeout):
+        """Block until a subscribed conversation has a message newer than after_id; False on timeout."""
+        with self._cond:
+            return self._cond.wait_for(lambda: self._latest.get(key, (0, 0))[0] > after_id, timeout)
+
+    def _ensure_watcher(self):
+        if self._pid == os.getpid():
+            return
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        threading.Thread(target=self._watch, name='message-watcher', daemon=True).start()
+
+    def _forget_old(self):
+        cutoff = time.monotonic() - app.config['CHAT_NOTIFIER_KEEP_SECONDS']
+        with self._cond:
+            for key in [key for key, (_, at) in self._latest.items() if at < cutoff]:
+                del self._latest[key]
+
+    def _watch(self):
+        table = Message.__table__
+        with app.app_context():
+            with db.engine.connect() as conn:
+                seen = conn.execute(db.select(db.func.max(table.c.id))).scalar() or 0
+            while True:
+                time.sleep(app.config['CHAT_NOTIFIER_POLL_INTERVAL'])
+                self._forget_old()
+                try:
+                    with db.engine.connect() as conn:
+                        newest = conn.execute(db.select(db.func.max(table.c.id))).scalar() or 0
+                        # Checked after reading the newest id: a stream subscribing
+                        # from here on reads the database after it, too.
+                        with self._cond:
+                            idle = not self._subscribed
+                        if idle:
+                            seen = max(seen, newest)
+                            continue
+                        rows = conn.execute(db.select(table.c.id, table.c.sender_id, table.c.receiver_id)
+                                            .where(table.c.id > seen).order_by(table.c.id)).all()
+                except Exception:
+                    app.logger.exception('Polling for new chat messages failed')
+                    continue
+                for message_id, sender_id, receiver_id in rows:
+                    self.publish(message_id, sender_id, receiver_id)
+                    seen = message_id
+
+message_notifier = MessageNotifier()
+
+class StreamLimiter:
+    """Counts the chat streams open in this process against CHAT_STREAMS_PER_PROCESS."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.open = 0
+        self.rejected = 0
+
+    def acquire(self):
+        with self._lock:
+            if self.open >= app.config['CHAT_STREAMS_PER_PROCESS']:
+                self.rejected += 1
+                return False
+            self.open += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.open -= 1
+
+    def stats(self):
+        return {'open': self.open, 'limit': app.config['CHAT_STREAMS_PER_PROCESS'], 'rejected': self.rejected}
+
+chat_streams = StreamLimiter()
+
+class UnreadCounter:
+    """Per-process cache of each user's unread message total.
+
+    Counts are read from the partial unread index at most once per
+    ``UNREAD_COUNT_TTL`` seconds per user. Sends and reads handled by this process
+    adjust the cached value directly; changes made through other workers show up
+    once the entry expires.
+    """
+
+    def __init__(self):
+        self.cache = TTLCache('UNREAD_COUNT_TTL', 'UNREAD_COUNT_MAX_ENTRIES')
+
+    def get(self, user_id):
+        return self.cache.get(user_id, self._count)
+
+    def adjust(self, user_id, delta):
+        self.cache.update(user_id, lambda count: max(0, count + delta))
+
+    @staticmethod
+    def _count(user_id):
+        return (db.session.query(db.func.count(Message.id))
+                .filter(Message.receiver_id == user_id, Message.is_read == db.false()).scalar())
+
+unread_counter = UnreadCounter()
+CACHES['unread_counts'] = unread_counter.cache
+
+@app.template_global()
+def unread_message_count():
+    return unread_counter.get(current_user.id) if current_user.is_authenticated else 0
+
+# Password hashing
+class PasswordHasherBusy(RuntimeError):
+    """Raised instead of queueing a hash behind PASSWORD_HASH_QUEUE others."""
+
+class PasswordHasher:
+    """Runs password hashing and verification on a bounded per-process thread pool.
+
+    hashlib's scrypt and PBKDF2 release the GIL, so request threads serving pages
+    keep running while the pool hashes. With PASSWORD_HASH_WORKERS set to 0 the work
+    runs inline in the request thread.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._executor = None
+        self._slots = None
+        self._method = self._method_prefix = None
+        self.completed = 0
+        self.rejected = 0
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, method=app.config['PASSWORD_HASH_METHOD'])
+
+    def check(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        return password_hash.split('$', 1)[0] != self.method_prefix
+
+    @property
+    def method_prefix(self):
+        """PASSWORD_HASH_METHOD as Werkzeug writes it into hashes, e.g. 'scrypt:32768:8:1' for 'scrypt'."""
+        method = app.config['PASSWORD_HASH_METHOD']
+        if self._method != method:
+            self._method_prefix = generate_password_hash('', method=method).split('$', 1)[0]
+            self._method = method
+        return self._method_prefix
+
+    def _run(self, func, *args, **kwargs):
+        if not app.config['PASSWORD_HASH_WORKERS']:
+            return func(*args, **kwargs)
+        self._ensure_pool()
+        if not self._slots.acquire(blocking=False):
+            self.rejected += 1
+            raise PasswordHasherBusy()
+        try:
+            return self._executor.submit(func, *args, **kwargs).result()
+        finally:
+            self._slots.release()
+            self.completed += 1
+
+    def _ensure_pool(self):
+        # Created lazily so that each forked gunicorn worker gets its own threads.
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._executor = ThreadPoolExecutor(app.config['PASSWORD_HASH_WORKERS'],
+                                                thread_name_prefix='password-hasher')
+            self._slots = threading.BoundedSemaphore(app.config['PASSWORD_HASH_QUEUE'])
+            self._pid = os.getpid()
+
+    def stats(self):
+        return {'method': app.config['PASSWORD_HASH_METHOD'], 'workers': app.config['PASSWORD_HASH_WORKERS'],
+                'completed': self.completed, 'rejected': self.rejected}
+
+password_hasher = PasswordHasher()
+
+@app.errorhandler(PasswordHasherBusy)
+def password_hasher_busy(error):
+    flash('Sunucu şu anda çok yoğun, lütfen birkaç saniye sonra tekrar deneyin.', 'warning')
+    return (render_template(f'{request.endpoint}.html', title='Sunucu Meşgul - MAHKEME Forum'),
+            503, {'Retry-After': '5'})
+
+# Anonymous full-page cache
+PAGE_CACHE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS page (
+    key TEXT PRIMARY KEY, etag TEXT NOT NULL, content_type TEXT NOT NULL,
+    body BLOB NOT NULL, expires_at REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS page_tag (
+    tag TEXT NOT NULL, key TEXT NOT NULL, PRIMARY KEY (tag, key)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS page_tag_key ON page_tag (key);
+CREATE INDEX IF NOT EXISTS page_expires_at ON page (expires_at);
+CREATE TABLE IF NOT EXISTS tag_invalidated (
+    tag TEXT PRIMARY KEY, at REAL NOT NULL) WITHOUT ROWID;
 '''
 
-BASE_FOOTER = '''
-    </div>
-    <footer class="mt-5">
-        <div class="container">
-            <div class="row">
-                <div class="col-md-6">
-                    <h5>MAHKEME Forum</h5>
-                    <p> İFŞALA GEÇ XD</p>
-                </div>
-                <div class="col-md-6 text-end">
-                    <p>&copy; 2025 MAHKEME Forum. Tüm hakları saklıdır.</p>
-                    <div class="social-links">
-                        <a href="#" class="me-2"><i class="fab fa-github fa-lg"></i></a>
-                        <a href="#" class="me-2"><i class="fab fa-twitter fa-lg"></i></a>
-                        <a href="#" class="me-2"><i class="fab fa-discord fa-lg"></i></a>
-                    </div>
-                </div>
-            </div>
-        </div>
-    </footer>
-    <script src="https://cdn.jsdelivr.net/npm/bootstrap@5.1.3/dist/js/bootstrap.bundle.min.js"></script>
-    <script>
-        var tooltipTriggerList = [].slice.call(document.querySelectorAll('[data-bs-toggle="tooltip"]'))
-        var tooltipList = tooltipTriggerList.map(function (tooltipTriggerEl) {
-            return new bootstrap.Tooltip(tooltipTriggerEl)
-        });
-        function scrollChatToBottom() {
-            const chatContainer = document.querySelector('.chat-messages');
-            if (chatContainer) {
-                chatContainer.scrollTop = chatContainer.scrollHeight;
-            }
+class PageCache:
+    """Rendered responses for anonymous GETs, shared by every worker on the host.
+
+    Entries are stored in a separate SQLite file with the tags of the data they
+    show (``thread:<id>``, ``user:<id>``, ``forum``). invalidate() drops every entry
+    carrying one of the given tags and records when it did. A render that started
+    before an invalidation of one of its tags is not stored, so a response built
+    from data older than the latest write can never be cached. Each process that
+    writes to the store prunes it every PAGE_CACHE_PRUNE_INTERVAL seconds, and
+    set() keeps it under PAGE_CACHE_MAX_BYTES.
+    """
+
+    # Every process reports the same store.
+    shared = True
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self._local = threading.local()
+        self._next_prune = 0
+
+    def _conn(self):
+        if getattr(self._local, 'pid', None) != os.getpid():
+            os.makedirs(os.path.dirname(app.config['PAGE_CACHE_PATH']), exist_ok=True)
+            conn = sqlite3.connect(app.config['PAGE_CACHE_PATH'], timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = OFF')
+            conn.executescript(PAGE_CACHE_SCHEMA)
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return self._local.conn
+
+    def get(self, key):
+        row = self._conn().execute('SELECT etag, content_type, body FROM page WHERE key = ? AND expires_at > ?',
+                                   (key, time.time())).fetchone()
+        if row is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return row
+
+    def set(self, key, body, content_type, tags, started):
+        etag = hashlib.sha256(body).hexdigest()
+        conn = self._conn()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            placeholders = ','.join('?' * len(tags))
+            stale = tags and conn.execute(f'SELECT 1 FROM tag_invalidated WHERE tag IN ({placeholders}) AND at >= ?',
+                                          (*tags, started)).fetchone()
+            if stale:
+                return None
+            conn.execute('INSERT OR REPLACE INTO page VALUES (?, ?, ?, ?, ?)',
+                         (key, etag, content_type, body, time.time() + app.config['PAGE_CACHE_TTL']))
+            conn.execute('DELETE FROM page_tag WHERE key = ?', (key,))
+            conn.executemany('INSERT INTO page_tag VALUES (?, ?)', [(tag, key) for tag in tags])
+            self._evict(conn)
+        self.prune_if_due()
+        return etag
+
+    def _evict(self, conn):
+        excess = (conn.execute('SELECT coalesce(sum(length(body)), 0) FROM page').fetchone()[0]
+                  - app.config['PAGE_CACHE_MAX_BYTES'])
+        victims = []
+        for key, size in conn.execute('SELECT key, length(body) FROM page ORDER BY expires_at'):
+            if excess <= 0:
+                break
+            victims.append((key,))
+            excess -= size
+        conn.executemany('DELETE FROM page WHERE key = ?', victims)
+        conn.executemany('DELETE FROM page_tag WHERE key = ?', victims)
+        self.evicted += len(victims)
+
+    def invalidate(self, *tags):
+        conn = self._conn()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            now = time.time()
+            conn.executemany('INSERT OR REPLACE INTO tag_invalidated VALUES (?, ?)', [(tag, now) for tag in tags])
+            placeholders = ','.join('?' * len(tags))
+            keys = [row[0] for row in conn.execute(
+                f'SELECT DISTINCT key FROM page_tag WHERE tag IN ({placeholders})', tags)]
+            conn.executemany('DELETE FROM page WHERE key = ?', [(key,) for key in keys])
+            conn.executemany('DELETE FROM page_tag WHERE key = ?', [(key,) for key in keys])
+        self.prune_if_due()
+
+    def clear(self):
+        """Drop every entry, e.g. after a change to how all pages render."""
+        conn = self._conn()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('DELETE FROM page')
+            conn.execute('DELETE FROM page_tag')
+
+    def prune(self, keep_invalidations):
+        """Drop expired entries and invalidation records older than ``keep_invalidations`` seconds."""
+        conn = self._conn()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            now = time.time()
+            conn.execute('DELETE FROM page WHERE expires_at <= ?', (now,))
+            conn.execute('DELETE FROM page_tag WHERE key NOT IN (SELECT key FROM page)')
+            conn.execute('DELETE FROM tag_invalidated WHERE at < ?', (now - keep_invalidations,))
+
+    def prune_if_due(self):
+        # The store is per host, so it cannot be left to the one process in the
+        # cluster that runs periodic jobs.
+        now = time.monotonic()
+        if now >= self._next_prune:
+            self._next_prune = now + app.config['PAGE_CACHE_PRUNE_INTERVAL']
+            self.prune(app.config['PAGE_CACHE_PRUNE_INTERVAL'])
+
+    def stats(self):
+        entries, size = self._conn().execute('SELECT count(*), coalesce(sum(length(body)), 0) FROM page').fetchone()
+        lookups = self.hits + self.misses
+        return {'entries': entries, 'bytes': size, 'hits': self.hits, 'misses': self.misses,
+                'evicted': self.evicted, 'hit_ratio': self.hits / lookups if lookups else None}
+
+page_cache = CACHES['pages'] = PageCache()
+
+def tag_page(*tags):
+    """Record what data the page being rendered shows, for invalidation."""
+    if 'page_tags' in g:
+        g.page_tags.update(tags)
+
+# The query arguments cached views read; any others do not change the page. Pages
+# reached through an ``after``/``before`` cursor are not cached: any timestamp and
+# id make a valid cursor, so they could fill the store with one-off entries.
+PAGE_CACHE_KEY_ARGS = ('sort', 'per_page')
+
+def page_cache_key():
+    args = {name: request.args[name] for name in PAGE_CACHE_KEY_ARGS if name in request.args}
+    return request.path + '?' + urllib.parse.urlencode(sorted(args.items()))
+
+def cache_anonymous_page(on_hit=None):
+    """Serve GETs from logged-out visitors out of page_cache, with strong ETags and 304s.
+
+    ``on_hit`` is called with the view arguments when a cached copy is served, for
+    side effects the view would otherwise have had (such as counting a view).
+    Streamed responses are passed through as they are generated and stored once
+    complete; the first visitor gets no ETag.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if (not app.config['PAGE_CACHE_ENABLED'] or request.method != 'GET'
+                    or current_user.is_authenticated or session.get('_flashes')
+                    or request.args.get('after') or request.args.get('before')):
+                return view(*args, **kwargs)
+            key = page_cache_key()
+            cached = page_cache.get(key)
+            if cached is not None:
+                etag, content_type, body = cached
+                if on_hit is not None:
+                    on_hit(*args, **kwargs)
+            else:
+                started = time.time()
+                g.page_tags = set()
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                if response.is_streamed:
+                    response.response = cache_streamed_page(response.response, key, response.content_type,
+                                                            g.page_tags, started)
+                    return response
+                body, content_type = response.get_data(), response.content_type
+                if len(body) > app.config['PAGE_CACHE_MAX_ENTRY_BYTES']:
+                    return response
+                etag = page_cache.set(key, body, content_type, sorted(g.page_tags), started)
+                if etag is None:
+                    return response
+            response = Response(body, content_type=content_type)
+            response.headers['Cache-Control'] = 'no-cache'
+            response.vary.add('Cookie')
+            return conditional_response(response, etag)
+        return wrapper
+    return decorator
+
+def cache_streamed_page(chunks, key, content_type, tags, started):
+    """Pass a streamed body through, storing it in page_cache if it is sent in full.
+
+    ``tags`` is the request's tag set; the view may keep adding to it while it streams.
+    Bodies over PAGE_CACHE_MAX_ENTRY_BYTES stop being collected and are not stored.
+    """
+    body, size = [], 0
+    try:
+        for chunk in chunks:
+            if body is not None:
+                data = chunk.encode() if isinstance(chunk, str) else chunk
+                size += len(data)
+                if size > app.config['PAGE_CACHE_MAX_ENTRY_BYTES']:
+                    body = None
+                else:
+                    body.append(data)
+            yield chunk
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+    if body is not None:
+        page_cache.set(key, b''.join(body), content_type, sorted(tags), started)
+
+def conditional_response(response, etag, last_modified=None):
+    """Set a strong ETag on response, or answer 304 if the client already has it.
+
+    compress_response() serves gzipped bodies under ``<etag>-gzip``, so a client
+    holding either variant gets a 304 carrying the tag it sent. ``last_modified``
+    (naive UTC) is also sent, and checked against If-Modified-Since when the
+    request has no If-None-Match.
+    """
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    held = next((tag for tag in (etag, f'{etag}-gzip') if request.if_none_match.contains(tag)), None)
+    if held is None and not request.if_none_match and last_modified is not None and request.if_modified_since:
+        if last_modified.replace(microsecond=0, tzinfo=timezone.utc) <= request.if_modified_since:
+            held = etag
+    if held is None:
+        return response
+    not_modified = Response(status=304, headers={'Cache-Control': response.headers['Cache-Control']})
+    not_modified.set_etag(held)
+    if last_modified is not None:
+        not_modified.last_modified = last_modified
+    not_modified.vary.update([*response.vary, 'Accept-Encoding'])
+    return not_modified
+
+# Multi-process metrics
+class Metrics:
+    """Request counts and latency histograms, aggregated across worker processes.
+
+    Each process counts in memory and, after serving requests, writes a snapshot to
+    ``METRICS_DIR/<pid>.json``, replacing the file atomically. A scrape writes its
+    own process's snapshot and then adds up every file: counters and histograms from
+    all of them, so requests served by workers that have since exited still count,
+    and gauges (pool and cache sizes) only from processes that are still running.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._requests = Counter()
+        self._latency = {}
+        self._dirty = False
+
+    def observe(self, endpoint, method, status, seconds):
+        self._ensure_writer()
+        endpoint = endpoint or 'unmatched'
+        buckets = app.config['METRICS_LATENCY_BUCKETS']
+        with self._lock:
+            self._requests[endpoint, method, status] += 1
+            histogram = self._latency.setdefault(endpoint, {'buckets': [0] * len(buckets), 'sum': 0.0, 'count': 0})
+            for i, bound in enumerate(buckets):
+                if seconds <= bound:
+                    histogram['buckets'][i] += 1
+                    break
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+            self._dirty = True
+
+    def snapshot(self):
+        with self._lock:
+            self._dirty = False
+            requests = [[*key, count] for key, count in self._requests.items()]
+            latency = json.loads(json.dumps(self._latency))
+        pool = db.engine.pool
+        return {
+            'requests': requests,
+            'latency': latency,
+            'pool': {'size': pool.size(), 'checked_out': pool.checkedout(), 'overflow': max(pool.overflow(), 0)}
+                    if hasattr(pool, 'checkedout') else {},
+            'caches': {name: dict(cache.stats(), shared=getattr(cache, 'shared', False))
+                       for name, cache in CACHES.items()},
         }
-        document.addEventListener('DOMContentLoaded', function() {
-            scrollChatToBottom();
-        });
-    </script>
-    {% block scripts %}{% endblock %}
-</body>
-</html>
-'''
+
+    def write(self):
+        folder = app.config['METRICS_DIR']
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f'{os.getpid()}.json')
+        with app.app_context():
+            snapshot = self.snapshot()
+        with open(path + '.tmp', 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(path + '.tmp', path)
+
+    def collect(self):
+        """Every process's snapshot, as (pid, alive, snapshot) tuples."""
+        self.write()
+        folder = app.config['METRICS_DIR']
+        snapshots = []
+        for name in os.listdir(folder):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(folder, name)) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue  # Removed or replaced while we read it.
+            pid = int(name[:-len('.json')])
+            snapshots.append((pid, process_alive(pid), snapshot))
+        return snapshots
+
+    def _ensure_writer(self):
+        # Started lazily so that each forked gunicorn worker runs its own thread.
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            # Counts inherited from the parent process are the parent's to report.
+            self._requests, self._latency = Counter(), {}
+        threading.Thread(target=self._run, name='metrics-writer', daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(app.config['METRICS_WRITE_INTERVAL'])
+            if not self._dirty:
+                continue
+            try:
+                self.write()
+            except Exception:
+                app.logger.exception('Writing the metrics snapshot failed')
+
+metrics = Metrics()
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def reset_metrics():
+    """Forget snapshots from earlier runs; call before any worker starts."""
+    shutil.rmtree(app.config['METRICS_DIR'], ignore_errors=True)
+
+def prometheus_labels(**labels):
+    if not labels:
+        return ''
+    escaped = {k: str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for k, v in labels.items()}
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped.items()) + '}'
+
+def render_metrics(snapshots):
+    """Sum per-process snapshots into the Prometheus text exposition format."""
+    buckets = app.config['METRICS_LATENCY_BUCKETS']
+    requests, latency = Counter(), {}
+    pool, caches, shared_gauges = Counter(), {}, {}
+    for pid, alive, snapshot in snapshots:
+        for endpoint, method, status, count in snapshot['requests']:
+            requests[endpoint, method, status] += count
+        for endpoint, histogram in snapshot['latency'].items():
+            total = latency.setdefault(endpoint, {'buckets': [0] * len(buckets), 'sum': 0.0, 'count': 0})
+            total['buckets'] = [a + b for a, b in zip(total['buckets'], histogram['buckets'])]
+            total['sum'] += histogram['sum']
+            total['count'] += histogram['count']
+        for name, stats in snapshot['caches'].items():
+            cache = caches.setdefault(name, Counter())
+            cache['hits'] += stats['hits']
+            cache['misses'] += stats['misses']
+            if alive:
+                for gauge in ('entries', 'bytes'):
+                    if gauge not in stats:
+                        continue
+                    # A shared cache reports the same store from every process.
+                    if stats['shared']:
+                        shared_gauges[name, gauge] = stats[gauge]
+                    else:
+                        cache[gauge] += stats[gauge]
+        if alive:
+            pool.update(snapshot['pool'])
+    for (name, gauge), value in shared_gauges.items():
+        caches[name][gauge] = value
+
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        lines.extend(f'{sample_name}{prometheus_labels(**labels)} {value}' for sample_name, labels, value in samples)
+
+    metric('mahkeme_http_requests_total', 'counter', 'Requests handled, by endpoint, method and status.',
+           [('mahkeme_http_requests_total', {'endpoint': e, 'method': m, 'status': s}, n)
+            for (e, m, s), n in sorted(requests.items())])
+    samples = []
+    for endpoint, histogram in sorted(latency.items()):
+        cumulative = 0
+        for bound, count in zip(buckets, histogram['buckets']):
+            cumulative += count
+            samples.append(('mahkeme_http_request_duration_seconds_bucket', {'endpoint': endpoint, 'le': bound},
+                            cumulative))
+        samples.append(('mahkeme_http_request_duration_seconds_bucket', {'endpoint': endpoint, 'le': '+Inf'},
+                        histogram['count']))
+        samples.append(('mahkeme_http_request_duration_seconds_sum', {'endpoint': endpoint}, histogram['sum']))
+        samples.append(('mahkeme_http_request_duration_seconds_count', {'endpoint': endpoint}, histogram['count']))
+    metric('mahkeme_http_request_duration_seconds', 'histogram', 'Time from request start to the last byte sent.',
+           samples)
+    metric('mahkeme_worker_processes', 'gauge', 'Processes currently reporting metrics.',
+           [('mahkeme_worker_processes', {}, sum(alive for _, alive, _ in snapshots))])
+    metric('mahkeme_db_pool_connections', 'gauge', 'Database pool connections across running processes.',
+           [('mahkeme_db_pool_connections', {'state': state}, n) for state, n in sorted(pool.items())])
+    metric('mahkeme_cache_hits_total', 'counter', 'Cache lookups answered from the cache.',
+           [('mahkeme_cache_hits_total', {'cache': name}, c['hits']) for name, c in sorted(caches.items())])
+    metric('mahkeme_cache_misses_total', 'counter', 'Cache lookups that had to load the value.',
+           [('mahkeme_cache_misses_total', {'cache': name}, c['misses']) for name, c in sorted(caches.items())])
+    metric('mahkeme_cache_hit_ratio', 'gauge', 'Hits over lookups since the processes started.',
+           [('mahkeme_cache_hit_ratio', {'cache': name}, c['hits'] / (c['hits'] + c['misses']))
+            for name, c in sorted(caches.items()) if c['hits'] + c['misses']])
+    metric('mahkeme_cache_entries', 'gauge', 'Entries held by running processes.',
+           [('mahkeme_cache_entries', {'cache': name}, c['entries']) for name, c in sorted(caches.items())])
+    metric('mahkeme_cache_bytes', 'gauge', 'Bytes held by caches that measure their size.',
+           [('mahkeme_cache_bytes', {'cache': name}, c['bytes']) for name, c in sorted(caches.items())
+            if 'bytes' in c])
+    return '\n'.join(lines) + '\n'
+
+# Fingerprinted static assets
+Asset = namedtuple('Asset', ['mimetype', 'etag', 'identity', 'gzip', 'br'])
+
+def load_assets(folder, subfolders=('css', 'js')):
+    """Read the CSS and JavaScript under ``folder``, keyed by their fingerprinted names.
+
+    ``css/forum.css`` becomes ``css/forum.<hash>.css``. The gzip and (if the brotli
+    module is installed) brotli variants are built here, once; under
+    ``gunicorn --preload`` the master does it and workers share the bytes.
+    """
+    assets, names = {}, {}
+    for subfolder in subfolders:
+        directory = os.path.join(folder, subfolder)
+        if not os.path.isdir(directory):
+            continue
+        for filename in sorted(os.listdir(directory)):
+            stem, extension = os.path.splitext(filename)
+            if extension not in ('.css', '.js'):
+                continue
+            with open(os.path.join(directory, filename), 'rb') as f:
+                body = f.read()
+            digest = hashlib.sha256(body).hexdigest()
+            fingerprinted = f'{subfolder}/{stem}.{digest[:12]}{extension}'
+            names[f'{subfolder}/{filename}'] = fingerprinted
+            assets[fingerprinted] = Asset(
+                mimetype='text/css' if extension == '.css' else 'text/javascript',
+                etag=digest,
+                identity=body,
+                gzip=gzip.compress(body, compresslevel=9, mtime=0),
+                br=brotli.compress(body) if brotli is not None else None)
+    return assets, names
+
+ASSETS, ASSET_NAMES = load_assets(app.static_folder)
+
+@app.template_global()
+def asset_url(name):
+    """URL of a file under static/css or static/js that changes whenever its content does."""
+    return url_for('asset', name=ASSET_NAMES[name])
+
+@app.route('/assets/<path:name>')
+def asset(name):
+    asset = ASSETS.get(name) or abort(404)
+    if asset.br is not None and request.accept_encodings['br']:
+        body, encoding = asset.br, 'br'
+    elif request.accept_encodings['gzip']:
+        body, encoding = asset.gzip, 'gzip'
+    else:
+        body, encoding = asset.identity, None
+    response = Response(body, mimetype=asset.mimetype)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.set_etag(f'{asset.etag}-{encoding}' if encoding else asset.etag)
+    # The name changes with the content, so browsers never need to revalidate.
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config['ASSET_MAX_AGE']
+    response.cache_control.immutable = True
+    return response
+
+# Response compression
+@app.after_request
+def compress_response(response):
+    """Gzip HTML, JSON and text responses for clients that accept it."""
+    if (not app.config['COMPRESS_ENABLED'] or not request.accept_encodings['gzip']
+            or response.status_code < 200 or response.status_code in (204, 304)
+            or response.direct_passthrough or 'Content-Encoding' in response.headers
+            or response.mimetype not in app.config['COMPRESS_MIMETYPES']):
+        return response
+    if response.is_streamed:
+        response.response = gzip_stream(response.iter_encoded(), app.config['COMPRESS_LEVEL'])
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < app.config['COMPRESS_MIN_BYTES']:
+            return response
+        response.set_data(gzip.compress(data, compresslevel=app.config['COMPRESS_LEVEL'], mtime=0))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f'{etag}-gzip', weak)
+    return response
+
+def gzip_stream(chunks, level):
+    """Compress an iterable of bytes, flushing after each chunk so nothing waits for the end."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # 31: gzip container
+    try:
+        for chunk in chunks:
+            data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+    yield compressor.flush()
+
+# Content-addressed avatar storage
+AVATAR_FORMATS = {'JPEG': 'jpg', 'PNG': 'png', 'GIF': 'gif', 'WEBP': 'webp'}
+AVATAR_MIMETYPES = {'jpg': 'image/jpeg', 'png': 'image/png', 'gif': 'image/gif', 'webp': 'image/webp'}
+
+class AvatarError(ValueError):
+    """An upload that cannot be used as an avatar; the message is shown to the user."""
+
+def avatar_extension(path):
+    """The extension to store the image at ``path`` under; AvatarError if it is not an accepted image.
+
+    Only the header is parsed (and the file checked for truncation where the format
+    allows), so this is cheap enough to run while the upload request waits.
+    """
+    try:
+        with Image.open(path) as image:
+            extension = AVATAR_FORMATS.get(image.format)
+            check_avatar_pixels(image)
+            image.verify()
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, SyntaxError):
+        raise AvatarError('Yüklenen dosya okunabilir bir resim değil.')
+    if extension is None:
+        raise AvatarError('Yalnızca JPEG, PNG, GIF veya WebP dosyası yükleyebilirsiniz.')
+    return extension
+
+def check_avatar_pixels(image):
+    width, height = image.size
+    if width * height > app.config['AVATAR_MAX_PIXELS']:
+        raise AvatarError(f"Profil fotoğrafı en fazla {app.config['AVATAR_MAX_PIXELS'] // 1000000} megapiksel olabilir.")
+
+def write_avatar_sizes(original, folder):
+    """Save a square crop of ``original`` at every AVATAR_SIZES size; returns the extension."""
+    try:
+        with Image.open(original) as image:
+            source_format = image.format
+            extension = AVATAR_FORMATS.get(source_format)
+            if extension is None:
+                raise AvatarError('Yalnızca JPEG, PNG, GIF veya WebP dosyası yükleyebilirsiniz.')
+            check_avatar_pixels(image)
+            largest = max(app.config['AVATAR_SIZES'])
+            mode = 'RGB' if extension == 'jpg' else 'RGBA'
+            # JPEGs are decoded at the smallest 1/2, 1/4 or 1/8 scale that still
+            # leaves twice the largest size, instead of at full resolution.
+            image.draft(mode, (2 * largest, 2 * largest))
+            image = ImageOps.exif_transpose(image)
+            if image.mode != mode:
+                image = image.convert(mode)
+            # Every size is cut from one square copy at the largest size.
+            image = ImageOps.fit(image, (largest, largest), Image.LANCZOS)
+            for size in app.config['AVATAR_SIZES']:
+                thumbnail = image if size == largest else image.resize((size, size), Image.LANCZOS)
+                # Written aside and renamed, so /avatars never serves half a file.
+                partial = os.path.join(folder, f'.{size}.{extension}')
+                thumbnail.save(partial, format=source_format, optimize=True)
+                os.replace(partial, os.path.join(folder, f'{size}.{extension}'))
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError):
+        raise AvatarError('Yüklenen dosya okunabilir bir resim değil.')
+    return extension
+
+def store_avatar(stream):
+    """Store an uploaded avatar and return the value for User.profile_pic.
+
+    The upload is copied to disk in chunks, refusing anything over AVATAR_MAX_BYTES,
+    and hashed on the way. Identical uploads share one directory, named after the
+    hash, holding the original and its resized copies. The directory is renamed
+    into place once the original is complete, so readers never see a partial one;
+    the resized copies are written by the resize-avatar job, which is added to the
+    session and so starts once the caller commits.
+    """
+    folder = app.config['AVATAR_FOLDER']
+    os.makedirs(folder, exist_ok=True)
+    staging = tempfile.mkdtemp(dir=folder, prefix='.upload-')
+    try:
+        original = os.path.join(staging, 'original')
+        digest = hashlib.sha256()
+        written = 0
+        with open(original, 'wb') as out:
+            while chunk := stream.read(64 * 1024):
+                written += len(chunk)
+                if written > app.config['AVATAR_MAX_BYTES']:
+                    raise AvatarError(f"Profil fotoğrafı en fazla "
+                                      f"{app.config['AVATAR_MAX_BYTES'] // (1024 * 1024)} MB olabilir.")
+                digest.update(chunk)
+                out.write(chunk)
+        extension = avatar_extension(original)
+        target = os.path.join(folder, digest.hexdigest())
+        if not os.path.isdir(target):
+            try:
+                os.rename(staging, target)
+            except OSError:
+                pass  # The same image was stored concurrently.
+            else:
+                enqueue('resize-avatar', digest=digest.hexdigest())
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    return f'avatars/{digest.hexdigest()}.{extension}'
+
+@job('resize-avatar', max_attempts=2)
+def resize_avatar(digest):
+    directory = os.path.join(app.config['AVATAR_FOLDER'], digest)
+    write_avatar_sizes(os.path.join(directory, 'original'), directory)
+
+@app.template_global()
+def avatar_url(profile_pic, size):
+    """URL of a user's avatar resized to ``size`` pixels."""
+    if profile_pic.startswith('avatars/'):
+        digest, extension = profile_pic[len('avatars/'):].split('.')
+        return url_for('avatar', digest=digest, size=size, extension=extension)
+    # Uploads from before content addressing, and the default picture.
+    return url_for('static', filename='uploads/' + profile_pic)
+
+# User-written bodies
+BODY_TOKEN = re.compile(r'`([^`\n]+)`|(https?://[^\s<>"`]*[^\s<>"`.,;:!?)\]\'])')
+BODY_BOLD = re.compile(r'(?<!\w)\*\*(?=\S)(.+?)(?<=\S)\*\*(?!\w)')
+BODY_ITALIC = re.compile(r'(?<![\w*])\*(?=[^\s*])([^*\n]+?)(?<=\S)\*(?![\w*])')
+
+def render_body(text):
+    """Convert a thread, reply or message body to HTML that is safe to emit as is.
+
+    Everything is escaped. The only markup produced is **bold**, *italic*, `code`,
+    links for http(s) URLs and a <br> per line break.
+    """
+    text = text.replace('\r\n', '\n')
+    parts, pos = [], 0
+    for match in BODY_TOKEN.finditer(text):
+        parts.append(render_inline(text[pos:match.start()]))
+        code, url = match.groups()
+        if code is not None:
+            parts.append(f'<code>{escape(code)}</code>')
+        else:
+            parts.append(f'<a href="{escape(url)}" rel="nofollow noopener noreferrer">{escape(url)}</a>')
+        pos = match.end()
+    parts.append(render_inline(text[pos:]))
+    return ''.join(parts).replace('\n', '<br>\n')
+
+def render_inline(text):
+    html = str(escape(text))
+    html = BODY_BOLD.sub(r'<strong>\1</strong>', html)
+    return BODY_ITALIC.sub(r'<em>\1</em>', html)
+
+@app.template_filter('body_html')
+def body_html(row):
+    """The stored HTML of a Thread, Post or Message, rendered on the fly if not backfilled yet."""
+    return Markup(row.content_html if row.content_html is not None else render_body(row.content))
+
+# Versioned schema migrations
+#
+# `flask db-upgrade` applies pending migrations once per deploy; workers only
+# compare the stored version with LATEST_SCHEMA_VERSION when they boot. Version 1
+# creates whatever tables are missing from the models, so every later migration
+# must be idempotent: it may run against a database that version 1 just created
+# with the newest model definitions.
+schema_version = db.Table('schema_version', db.Column('version', db.Integer, nullable=False))
+
+MIGRATIONS = []
+
+def migration(version, description):
+    def register(func):
+        MIGRATIONS.append((version, description, func))
+        return func
+    return register
+
+@migration(1, 'Create the initial tables')
+def create_initial_tables(conn):
+    db.metadata.create_all(conn)
+
+def create_indexes(conn, *names):
+    """Create the named model indexes that do not exist yet.
+
+    Migrations name the indexes they add rather than creating all of a table's
+    current ones, which may cover columns a later migration adds.
+    """
+    indexes = {index.name: index for table in db.metadata.tables.values() for index in table.indexes}
+    for name in names:
+        indexes[name].create(conn, checkfirst=True)
+
+@migration(2, 'Add indexes for the forum, thread, profile and chat queries')
+def add_hot_query_indexes(conn):
+    create_indexes(conn, 'ix_thread_updated_at_id', 'ix_thread_user_id_created_at',
+                   'ix_post_thread_id_created_at_id', 'ix_post_user_id_created_at', 'ix_message_conversation')
+
+# Full-text search index over thread titles/bodies and replies. Row ids encode the
+# source row (thread id * 2, post id * 2 + 1) so triggers can update one entry
+# without scanning the index.
+SEARCH_INDEX_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+        title, body, thread_id UNINDEXED, tokenize = 'unicode61 remove_diacritics 2')""",
+    """CREATE TRIGGER IF NOT EXISTS thread_search_insert AFTER INSERT ON thread BEGIN
+        INSERT INTO search_index(rowid, title, body, thread_id) VALUES (new.id * 2, new.title, new.content, new.id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS thread_search_update AFTER UPDATE OF title, content ON thread BEGIN
+        DELETE FROM search_index WHERE rowid = old.id * 2;
+        INSERT INTO search_index(rowid, title, body, thread_id) VALUES (new.id * 2, new.title, new.content, new.id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS thread_search_delete AFTER DELETE ON thread BEGIN
+        DELETE FROM search_index WHERE rowid = old.id * 2;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS post_search_insert AFTER INSERT ON post BEGIN
+        INSERT INTO search_index(rowid, title, body, thread_id) VALUES (new.id * 2 + 1, '', new.content, new.thread_id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS post_search_update AFTER UPDATE OF content ON post BEGIN
+        DELETE FROM search_index WHERE rowid = old.id * 2 + 1;
+        INSERT INTO search_index(rowid, title, body, thread_id) VALUES (new.id * 2 + 1, '', new.content, new.thread_id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS post_search_delete AFTER DELETE ON post BEGIN
+        DELETE FROM search_index WHERE rowid = old.id * 2 + 1;
+    END""",
+    # Title matches weigh ten times as much as body matches in bm25 ranking.
+    "INSERT INTO search_index(search_index, rank) VALUES ('rank', 'bm25(10.0, 1.0)')",
+]
+
+REBUILD_SEARCH_INDEX_SQL = [
+    "DELETE FROM search_index",
+    "INSERT INTO search_index(rowid, title, body, thread_id) SELECT id * 2, title, content, id FROM thread",
+    "INSERT INTO search_index(rowid, title, body, thread_id) SELECT id * 2 + 1, '', content, thread_id FROM post",
+    "INSERT INTO search_index(search_index) VALUES ('optimize')",
+]
+
+@migration(3, 'Add the FTS5 search index and the triggers that maintain it')
+def add_search_index(conn):
+    if conn.dialect.name != 'sqlite':
+        return
+    for statement in SEARCH_INDEX_DDL + REBUILD_SEARCH_INDEX_SQL:
+        conn.exec_driver_sql(statement)
+
+@migration(4, 'Add the partial index on unread messages')
+def add_unread_message_index(conn):
+    create_indexes(conn, 'ix_message_unread')
+
+@migration(5, 'Add the index on received messages for the inbox')
+def add_received_message_index(conn):
+    create_indexes(conn, 'ix_message_receiver')
+
+@migration(6, 'Widen user.password_hash for scrypt hashes')
+def widen_password_hash(conn):
+    # SQLite does not enforce VARCHAR lengths.
+    if conn.dialect.name == 'postgresql':
+        conn.exec_driver_sql('ALTER TABLE "user" ALTER COLUMN password_hash TYPE VARCHAR(255)')
+    elif conn.dialect.name in ('mysql', 'mariadb'):
+        conn.exec_driver_sql('ALTER TABLE user MODIFY password_hash VARCHAR(255) NOT NULL')
+
+@migration(7, 'Add content_html to threads, replies and messages')
+def add_content_html(conn):
+    # New rows get it on write; `flask backfill-body-html` fills in existing ones.
+    for model in (Thread, Post, Message):
+        table = model.__table__
+        if 'content_html' not in {column['name'] for column in db.inspect(conn).get_columns(table.name)}:
+            conn.exec_driver_sql(f'ALTER TABLE "{table.name}" ADD COLUMN content_html TEXT')
+
+@migration(8, 'Add Thread.hot_score, its index and the app_state table')
+def add_hot_score(conn):
+    if 'hot_score' not in {column['name'] for column in db.inspect(conn).get_columns('thread')}:
+        conn.exec_driver_sql('ALTER TABLE thread ADD COLUMN hot_score FLOAT NOT NULL DEFAULT 0')
+    create_indexes(conn, 'ix_thread_hot_score_id')
+    app_state.create(conn, checkfirst=True)
+    rebuild_hot_scores(conn)
+
+@migration(9, 'Add the job queue and lease tables')
+def add_job_tables(conn):
+    Job.__table__.create(conn, checkfirst=True)
+    create_indexes(conn, 'ix_job_state_run_at_id')
+    job_lease.create(conn, checkfirst=True)
+
+@migration(10, 'Add the reply counters to threads from before versioned migrations')
+def add_thread_counters(conn):
+    # Migration 1 only creates missing tables, so a database that predates it
+    # keeps a thread table without these columns.
+    existing = {column['name'] for column in db.inspect(conn).get_columns('thread')}
+    added = False
+    for name, ddl in (('reply_count', 'INTEGER NOT NULL DEFAULT 0'),
+                      ('last_post_at', 'DATETIME' if conn.dialect.name == 'sqlite' else 'TIMESTAMP'),
+                      ('last_post_user_id', 'INTEGER REFERENCES "user" (id)')):
+        if name not in existing:
+            conn.exec_driver_sql(f'ALTER TABLE thread ADD COLUMN {name} {ddl}')
+            added = True
+    if added:
+        conn.execute(thread_counters_update())
+
+LATEST_SCHEMA_VERSION = max(version for version, _, _ in MIGRATIONS)
+
+def current_schema_version(conn):
+    if not db.inspect(conn).has_table('schema_version'):
+        return 0
+    return conn.execute(db.select(db.func.max(schema_version.c.version))).scalar() or 0
+
+def upgrade_schema(log=lambda message: None):
+    """Apply every pending migration in order, each in its own transaction."""
+    with db.engine.begin() as conn:
+        schema_version.create(conn, checkfirst=True)
+    applied = 0
+    for version, description, func in sorted(MIGRATIONS, key=lambda m: m[0]):
+        with db.engine.begin() as conn:
+            if version <= current_schema_version(conn):
+                continue
+            func(conn)
+            conn.execute(schema_version.delete())
+            conn.execute(schema_version.insert().values(version=version))
+        log(f'Applied migration {version}: {description}')
+        applied += 1
+    return applied
+
+def check_schema():
+    """Refuse to serve from a database that `flask db-upgrade` has not brought up to date."""
+    with db.engine.connect() as conn:
+        version = current_schema_version(conn)
+    if version != LATEST_SCHEMA_VERSION:
+        raise RuntimeError(f'Database schema is at version {version}, expected {LATEST_SCHEMA_VERSION}; '
+                           'run `flask --app main db-upgrade` first.')
 
 # Routes
 @app.route('/')
 def home():
-    return render_template_string(BASE_HEADER + '''
-<div id="intro" style="position: fixed; top: 0; left: 0; width: 100%; height: 100%; background: black; z-index: 9999; display: flex; justify-content: center; align-items: center;">
-    <pre id="intro-text" class="intro-text"></pre>
-</div>
-<script>
-    const introText = `root@kali:~$ sudo systemctl start mahkeme-forum
-[OK] Initializing mahkeme Forum Network...
-[OK] System Root Login Successful
-[OK] Accessing Cehennem Interface...`;
-    const introElement = document.getElementById('intro-text');
-    let i = 0;
-    const typingSpeed = 30;
-    function typeWriter() {
-        if (i < introText.length) {
-            introElement.textContent += introText.charAt(i);
-            i++;
-            setTimeout(typeWriter, typingSpeed);
-        } else {
-            const remainingTime = 4000 - (i * typingSpeed);
-            setTimeout(() => {
-                window.location.href = "{{ url_for('forum') }}";
-            }, remainingTime > 0 ? remainingTime : 0);
-        }
-    }
-    typeWriter();
-</script>
-''' + BASE_FOOTER, title='MAHKEME Forum - Ana Sayfa')
+    return render_template('home.html', title='MAHKEME Forum - Ana Sayfa')
 
 @app.route('/register', methods=['GET', 'POST'])
 def register():
@@ -402,35 +2101,13 @@ def register():
             return redirect(url_for('register'))
         user = User(
             username=username, 
-            password_hash=generate_password_hash(password)
+            password_hash=password_hasher.hash(password)
         )
         db.session.add(user)
         db.session.commit()
         flash('Kayıt başarılı! Giriş yapabilirsiniz.', 'success')
         return redirect(url_for('login'))
-    return render_template_string(BASE_HEADER + '''
-<div class="row justify-content-center">
-    <div class="col-md-6">
-        <div class="forum-container">
-            <h2 class="text-center mb-4"><i class="fas fa-user-plus me-2"></i>Kayıt Ol</h2>
-            <form method="POST">
-                <div class="mb-3">
-                    <label for="username" class="form-label">Kullanıcı Adı</label>
-                    <input type="text" class="form-control" id="username" name="username" required>
-                </div>
-                <div class="mb-4">
-                    <label for="password" class="form-label">Şifre</label>
-                    <input type="password" class="form-control" id="password" name="password" required>
-                </div>
-                <button type="submit" class="btn btn-primary w-100 py-2">Kayıt Ol</button>
-            </form>
-            <div class="text-center mt-3">
-                Zaten hesabınız var mı? <a href="{{ url_for('login') }}">Giriş yapın</a>
-            </div>
-        </div>
-    </div>
-</div>
-''' + BASE_FOOTER, title='Kayıt Ol - MAHKEME Forum')
+    return render_template('register.html', title='Kayıt Ol - MAHKEME Forum')
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -441,35 +2118,19 @@ def login():
             flash('Kullanıcı adı ve şifre zorunludur!', 'danger')
             return redirect(url_for('login'))
         user = User.query.filter_by(username=username).first()
-        if user and check_password_hash(user.password_hash, password):
+        if user and password_hasher.check(user.password_hash, password):
+            if password_hasher.needs_rehash(user.password_hash):
+                try:
+                    user.password_hash = password_hasher.hash(password)
+                    db.session.commit()
+                except PasswordHasherBusy:
+                    pass  # Upgrade on a later login rather than fail this one.
             login_user(user)
             next_page = request.args.get('next')
             flash('Başarıyla giriş yaptınız!', 'success')
             return redirect(next_page or url_for('forum'))
         flash('Kullanıcı adı veya şifre hatalı!', 'danger')
-    return render_template_string(BASE_HEADER + '''
-<div class="row justify-content-center">
-    <div class="col-md-6">
-        <div class="forum-container">
-            <h2 class="text-center mb-4"><i class="fas fa-sign-in-alt me-2"></i>Giriş Yap</h2>
-            <form method="POST">
-                <div class="mb-3">
-                    <label for="username" class="form-label">Kullanıcı Adı</label>
-                    <input type="text" class="form-control" id="username" name="username" required>
-                </div>
-                <div class="mb-4">
-                    <label for="password" class="form-label">Şifre</label>
-                    <input type="password" class="form-control" id="password" name="password" required>
-                </div>
-                <button type="submit" class="btn btn-primary w-100 py-2">Giriş Yap</button>
-            </form>
-            <div class="text-center mt-3">
-                Hesabınız yok mu? <a href="{{ url_for('register') }}">Kayıt olun</a>
-            </div>
-        </div>
-    </div>
-</div>
-''' + BASE_FOOTER, title='Giriş Yap - MAHKEME Forum')
+    return render_template('login.html', title='Giriş Yap - MAHKEME Forum')
 
 @app.route('/logout')
 @login_required
@@ -481,152 +2142,63 @@ def logout():
 @app.route('/profile', methods=['GET', 'POST'])
 @login_required
 def profile():
+    # current_user is a cached, detached record; edits go through the real row.
+    user = db.session.get(User, current_user.id)
     if request.method == 'POST':
-        current_user.bio = request.form.get('bio', '')
+        user.bio = request.form.get('bio', '')
         if 'profile_pic' in request.files:
             file = request.files['profile_pic']
             if file and file.filename:
-                filename = secure_filename(file.filename)
-                file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-                current_user.profile_pic = filename
+                try:
+                    user.profile_pic = store_avatar(file.stream)
+                except AvatarError as error:
+                    flash(str(error), 'danger')
+                    return redirect(url_for('profile'))
         db.session.commit()
+        user_cache.invalidate(user.id)
+        page_cache.invalidate(f'user:{user.id}')
         flash('Profiliniz güncellendi!', 'success')
-        return redirect(url_for('user_profile', username=current_user.username))
-    return render_template_string(BASE_HEADER + '''
-<div class="row justify-content-center">
-    <div class="col-md-8">
-        <div class="forum-container">
-            <h2 class="mb-4"><i class="fas fa-user-edit me-2"></i>Profil Düzenle</h2>
-            <div class="text-center mb-4">
-                <img src="{{ url_for('static', filename='uploads/' + current_user.profile_pic) }}" 
-                     class="profile-avatar" alt="Profil Fotoğrafı">
-            </div>
-            <form method="POST" enctype="multipart/form-data">
-                <div class="mb-3">
-                    <label for="bio" class="form-label">Biyografi</label>
-                    <textarea class="form-control" id="bio" name="bio" rows="4">{{ current_user.bio or '' }}</textarea>
-                </div>
-                <div class="mb-4">
-                    <label for="profile_pic" class="form-label">Profil Fotoğrafı</label>
-                    <input class="form-control" type="file" id="profile_pic" name="profile_pic">
-                </div>
-                <button type="submit" class="btn btn-primary w-100 py-2">Değişiklikleri Kaydet</button>
-            </form>
-        </div>
-    </div>
-</div>
-''' + BASE_FOOTER, title='Profil Düzenle - MAHKEME Forum', current_user=current_user)
+        return redirect(url_for('user_profile', username=user.username))
+    return render_template('profile.html', title='Profil Düzenle - MAHKEME Forum', user=user)
+
+@app.route('/avatars/<digest>/<int:size>.<extension>')
+def avatar(digest, size, extension):
+    if not re.fullmatch(r'[0-9a-f]{64}', digest) or extension not in AVATAR_MIMETYPES:
+        abort(404)
+    folder = os.path.join(app.config['AVATAR_FOLDER'], digest)
+    # Sizes added to AVATAR_SIZES after an upload fall back to the original.
+    name = f'{size}.{extension}' if size in app.config['AVATAR_SIZES'] else 'original'
+    if not os.path.exists(os.path.join(folder, name)):
+        if name != 'original':
+            # Not resized yet; the resize-avatar job will replace this shortly.
+            return send_from_directory(folder, 'original', mimetype=AVATAR_MIMETYPES[extension], max_age=60)
+        abort(404)
+    response = send_from_directory(folder, name, mimetype=AVATAR_MIMETYPES[extension],
+                                   max_age=app.config['AVATAR_MAX_AGE'])
+    # The URL names the content, so it never has to be revalidated.
+    response.cache_control.immutable = True
+    return response
 
 @app.route('/user/<username>')
+@cache_anonymous_page()
 def user_profile(username):
     user = User.query.filter_by(username=username).first_or_404()
+    tag_page(f'user:{user.id}')
     threads = Thread.query.filter_by(user_id=user.id).order_by(Thread.created_at.desc()).limit(5).all()
     posts = Post.query.filter_by(user_id=user.id).order_by(Post.created_at.desc()).limit(5).all()
-    return render_template_string(BASE_HEADER + '''
-<div class="profile-header">
-    <div class="row align-items-center">
-        <div class="col-md-3 text-center">
-            <img src="{{ url_for('static', filename='uploads/' + user.profile_pic) }}" 
-                 class="profile-avatar" alt="{{ user.username }}">
-        </div>
-        <div class="col-md-9">
-            <h2>{{ user.username }}</h2>
-            <p class="mb-2"><i class="fas fa-calendar-alt me-2"></i>Üyelik: {{ user.join_date.strftime('%d.%m.%Y') }}</p>
-            {% if user.bio %}
-            <p class="mb-0">{{ user.bio }}</p>
-            {% else %}
-            <p class="text-muted">Bu kullanıcı henüz bir biyografi eklememiş.</p>
-            {% endif %}
-        </div>
-    </div>
-</div>
-<div class="row">
-    <div class="col-md-6">
-        <div class="forum-container">
-            <h4 class="mb-4"><i class="fas fa-file-alt me-2"></i>Son Başlıklar</h4>
-            {% if threads %}
-                {% for thread in threads %}
-                <div class="thread-card">
-                    <h5><a href="{{ url_for('thread', thread_id=thread.id) }}">{{ thread.title }}</a></h5>
-                    <p class="thread-meta">{{ thread.created_at.strftime('%d.%m.%Y %H:%M') }}</p>
-                </div>
-                {% endfor %}
-            {% else %}
-                <p class="text-muted">Bu kullanıcı henüz başlık oluşturmamış.</p>
-            {% endif %}
-        </div>
-    </div>
-    <div class="col-md-6">
-        <div class="forum-container">
-            <h4 class="mb-4"><i class="fas fa-comments me-2"></i>Son Yorumlar</h4>
-            {% if posts %}
-                {% for post in posts %}
-                <div class="post-card">
-                    <p>{{ post.content[:100] }}{% if post.content|length > 100 %}...{% endif %}</p>
-                    <p class="thread-meta">
-                        <a href="{{ url_for('thread', thread_id=post.thread_id) }}">Konuya git</a> • 
-                        {{ post.created_at.strftime('%d.%m.%Y %H:%M') }}
-                    </p>
-                </div>
-                {% endfor %}
-            {% else %}
-                <p class="text-muted">Bu kullanıcı henüz yorum yapmamış.</p>
-            {% endif %}
-        </div>
-    </div>
-</div>
-{% if current_user.is_authenticated and current_user.id != user.id %}
-<a href="{{ url_for('chat', user_id=user.id) }}" class="floating-btn" data-bs-toggle="tooltip" title="Mesaj Gönder">
-    <i class="fas fa-comment"></i>
-</a>
-{% endif %}
-''' + BASE_FOOTER, title=f'{user.username} - MAHKEME Forum', user=user, threads=threads, posts=posts, current_user=current_user)
+    return render_template('user_profile.html', title=f'{user.username} - MAHKEME Forum', user=user, threads=threads, posts=posts)
 
 @app.route('/forum')
+@cache_anonymous_page()
 def forum():
-    threads = Thread.query.order_by(Thread.updated_at.desc()).all()
-    return render_template_string(BASE_HEADER + '''
-<div class="d-flex justify-content-between align-items-center mb-4">
-    <h2><i class="fas fa-fire me-2"></i>Son Konular</h2>
-    {% if current_user.is_authenticated %}
-    <a href="{{ url_for('create_thread') }}" class="btn btn-primary">
-        <i class="fas fa-plus me-1"></i> Yeni Konu
-    </a>
-    {% endif %}
-</div>
-<div class="forum-container">
-    {% if threads %}
-        {% for thread in threads %}
-        <div class="thread-card">
-            <div class="row">
-                <div class="col-md-8">
-                    <h4 class="thread-title">
-                        <a href="{{ url_for('thread', thread_id=thread.id) }}">{{ thread.title }}</a>
-                    </h4>
-                    <p class="thread-meta">
-                        <img src="{{ url_for('static', filename='uploads/' + thread.author.profile_pic) }}" 
-                             class="user-avatar me-2" width="30" height="30">
-                        <a href="{{ url_for('user_profile', username=thread.author.username) }}">{{ thread.author.username }}</a> • 
-                        {{ thread.created_at.strftime('%d.%m.%Y %H:%M') }} • 
-                        {{ thread.views }} görüntüleme
-                    </p>
-                </div>
-                <div class="col-md-4 text-end">
-                    <span class="badge bg-secondary me-2">{{ thread.posts|length }} yorum</span>
-                    <span class="category-badge">Genel</span>
-                </div>
-            </div>
-        </div>
-        {% endfor %}
-    {% else %}
-        <div class="text-center py-4">
-            <i class="fas fa-comments fa-3x mb-3 text-muted"></i>
-            <h4 class="text-muted">Henüz hiç konu bulunmuyor</h4>
-            <p>İlk konuyu oluşturmak için <a href="{{ url_for('create_thread') }}">tıklayın</a>.</p>
-        </div>
-    {% endif %}
-</div>
-''' + BASE_FOOTER, title='Forum - MAHKEME Forum', threads=threads, current_user=current_user)
+    sort = requested_thread_sort()
+    after, before = requested_thread_cursors(sort)
+    per_page = requested_page_size('FORUM_PAGE_SIZE', 'FORUM_MAX_PAGE_SIZE')
+    query = Thread.query.options(joinedload(Thread.author), joinedload(Thread.last_poster))
+    page = paginate_threads(query, after=after, before=before, per_page=per_page, sort=sort)
+    threads = page.items
+    tag_page('forum', *{f'user:{t.user_id}' for t in threads}, *{f'user:{t.last_post_user_id}' for t in threads})
+    return render_template('forum.html', title='Forum - MAHKEME Forum', threads=threads, page=page, sort=sort)
 
 @app.route('/create_thread', methods=['GET', 'POST'])
 @login_required
@@ -640,119 +2212,144 @@ def create_thread():
         thread = Thread(
             title=title, 
             content=content, 
-            user_id=current_user.id
+            content_html=render_body(content),
+            user_id=current_user.id,
+            hot_score=hot_increment(app.config['HOT_THREAD_WEIGHT'])
         )
         db.session.add(thread)
         db.session.commit()
+        page_cache.invalidate('forum', f'user:{current_user.id}')
         flash('Konunuz başarıyla oluşturuldu!', 'success')
         return redirect(url_for('thread', thread_id=thread.id))
-    return render_template_string(BASE_HEADER + '''
-<div class="row justify-content-center">
-    <div class="col-md-10">
-        <div class="forum-container">
-            <h2 class="mb-4"><i class="fas fa-plus-circle me-2"></i>Yeni Konu Oluştur</h2>
-            <form method="POST">
-                <div class="mb-3">
-                    <label for="title" class="form-label">Başlık</label>
-                    <input type="text" class="form-control" id="title" name="title" required>
-                </div>
-                <div class="mb-4">
-                    <label for="content" class="form-label">İçerik</label>
-                    <textarea class="form-control" id="content" name="content" rows="8" required></textarea>
-                </div>
-                <button type="submit" class="btn btn-primary py-2 px-4">Konuyu Oluştur</button>
-                <a href="{{ url_for('forum') }}" class="btn btn-secondary py-2 px-4 ms-2">İptal</a>
-            </form>
-        </div>
-    </div>
-</div>
-''' + BASE_FOOTER, title='Yeni Konu - MAHKEME Forum', current_user=current_user)
+    return render_template('create_thread.html', title='Yeni Konu - MAHKEME Forum')
 
 @app.route('/thread/<int:thread_id>', methods=['GET', 'POST'])
+@cache_anonymous_page(on_hit=view_counter.record)
 def thread(thread_id):
-    thread = Thread.query.get_or_404(thread_id)
-    thread.views += 1
-    db.session.commit()
+    thread = Thread.query.options(joinedload(Thread.author)).get_or_404(thread_id)
+    if request.method == 'GET':
+        view_counter.record(thread.id)
     if request.method == 'POST' and current_user.is_authenticated:
         content = request.form.get('content')
         if not content:
             flash('Yorum içeriği boş olamaz!', 'danger')
             return redirect(url_for('thread', thread_id=thread_id))
+        now = datetime.utcnow()
         post = Post(
             content=content, 
+            content_html=render_body(content),
             user_id=current_user.id, 
-            thread_id=thread_id
+            thread_id=thread_id,
+            created_at=now
         )
         db.session.add(post)
-        thread.updated_at = datetime.utcnow()
+        thread.updated_at = now
+        thread.reply_count = Thread.reply_count + 1
+        thread.hot_score = Thread.hot_score + hot_increment(app.config['HOT_POST_WEIGHT'])
+        thread.last_post_at = now
+        thread.last_post_user_id = current_user.id
         db.session.commit()
+        page_cache.invalidate(f'thread:{thread_id}', 'forum', f'user:{current_user.id}')
         flash('Yorumunuz gönderildi!', 'success')
         return redirect(url_for('thread', thread_id=thread_id))
-    posts = Post.query.filter_by(thread_id=thread_id).order_by(Post.created_at.asc()).all()
-    return render_template_string(BASE_HEADER + '''
-<div class="forum-container mb-4">
-    <nav aria-label="breadcrumb">
-        <ol class="breadcrumb">
-            <li class="breadcrumb-item"><a href="{{ url_for('forum') }}">Forum</a></li>
-            <li class="breadcrumb-item active">{{ thread.title }}</li>
-        </ol>
-    </nav>
-    <div class="thread-card mb-4">
-        <div class="d-flex align-items-start">
-            <div class="flex-shrink-0 me-3">
-                <img src="{{ url_for('static', filename='uploads/' + thread.author.profile_pic) }}" 
-                     class="user-avatar" width="50" height="50" alt="{{ thread.author.username }}">
-            </div>
-            <div class="flex-grow-1">
-                <h3 class="thread-title">{{ thread.title }}</h3>
-                <div class="thread-content mb-3">
-                    {{ thread.content|replace('\n', '<br>')|safe }}
-                </div>
-                <div class="thread-meta">
-                    <a href="{{ url_for('user_profile', username=thread.author.username) }}" class="fw-bold">{{ thread.author.username }}</a> • 
-                    {{ thread.created_at.strftime('%d.%m.%Y %H:%M') }} • 
-                    {{ thread.views }} görüntüleme
-                </div>
-            </div>
-        </div>
-    </div>
-    <h4 class="mb-3">{{ posts|length }} Yorum</h4>
-    {% for post in posts %}
-    <div class="post-card mb-3">
-        <div class="d-flex align-items-start">
-            <div class="flex-shrink-0 me-3">
-                <img src="{{ url_for('static', filename='uploads/' + post.author.profile_pic) }}" 
-                     class="user-avatar" width="40" height="40" alt="{{ post.author.username }}">
-            </div>
-            <div class="flex-grow-1">
-                <div class="d-flex justify-content-between align-items-center mb-2">
-                    <a href="{{ url_for('user_profile', username=post.author.username) }}" class="fw-bold">{{ post.author.username }}</a>
-                    <span class="text-muted small">{{ post.created_at.strftime('%d.%m.%Y %H:%M') }}</span>
-                </div>
-                <div class="post-content">
-                    {{ post.content|replace('\n', '<br>')|safe }}
-                </div>
-            </div>
-        </div>
-    </div>
-    {% endfor %}
-    {% if current_user.is_authenticated %}
-    <div class="mt-4">
-        <h5 class="mb-3">Yorum Yap</h5>
-        <form method="POST">
-            <div class="mb-3">
-                <textarea class="form-control" name="content" rows="4" placeholder="Yorumunuzu buraya yazın..." required></textarea>
-            </div>
-            <button type="submit" class="btn btn-primary">Gönder</button>
-        </form>
-    </div>
-    {% else %}
-    <div class="alert alert-info mt-4">
-        Yorum yapmak için <a href="{{ url_for('login') }}">giriş yapmalısınız</a>.
-    </div>
-    {% endif %}
-</div>
-''' + BASE_FOOTER, title=f'{thread.title} - MAHKEME Forum', thread=thread, posts=posts, current_user=current_user)
+    posts = (Post.query.options(joinedload(Post.author))
+             .filter_by(thread_id=thread_id).order_by(Post.created_at.asc(), Post.id.asc()))
+    title = f'{thread.title} - MAHKEME Forum'
+    tag_page(f'thread:{thread_id}', f'user:{thread.user_id}')
+    if thread.reply_count >= app.config['THREAD_STREAM_MIN_REPLIES']:
+        posts = tag_post_authors(posts.yield_per(app.config['THREAD_STREAM_BATCH_SIZE']))
+        return Response(buffered_chunks(stream_template('thread.html', title=title, thread=thread, posts=posts),
+                                        app.config['THREAD_STREAM_CHUNK_BYTES']))
+    posts = posts.all()
+    tag_page(*{f'user:{p.user_id}' for p in posts})
+    return render_template('thread.html', title=title, thread=thread, posts=posts)
+
+def tag_post_authors(posts):
+    for post in posts:
+        tag_page(f'user:{post.user_id}')
+        yield post
+
+def buffered_chunks(chunks, size):
+    """Join the many small pieces Jinja yields into writes of about ``size`` characters."""
+    buffer, length = [], 0
+    try:
+        for chunk in chunks:
+            buffer.append(chunk)
+            length += len(chunk)
+            if length >= size:
+                yield ''.join(buffer)
+                buffer, length = [], 0
+    finally:
+        chunks.close()
+    if buffer:
+        yield ''.join(buffer)
+
+def fts_query(text):
+    """Quote every term so user input is matched literally, never parsed as FTS5 syntax."""
+    return ' '.join('"' + term.replace('"', '""') + '"' for term in text.split())
+
+@app.template_filter('highlight')
+def highlight(snippet):
+    # snippet() marks matches with control characters so the text can be escaped first.
+    return Markup(escape(snippet).replace('\x02', Markup('<mark>')).replace('\x03', Markup('</mark>')))
+
+@app.route('/search')
+def search():
+    q = request.args.get('q', '').strip()
+    results, next_cursor = [], None
+    if q and db.engine.dialect.name != 'sqlite':
+        flash('Arama bu veritabanında kullanılamıyor.', 'warning')
+    elif q:
+        params = {'query': fts_query(q), 'limit': app.config['SEARCH_PAGE_SIZE'] + 1}
+        keyset = ''
+        if request.args.get('after'):
+            params['rank'], params['rowid'] = decode_cursor(request.args['after'], float, int) or abort(400)
+            keyset = 'AND (search_index.rank > :rank OR (search_index.rank = :rank AND search_index.rowid > :rowid))'
+        rows = db.session.execute(db.text(f"""
+            SELECT search_index.rowid AS rowid, search_index.rank AS rank, thread.id AS thread_id,
+                   thread.title AS thread_title,
+                   snippet(search_index, 0, char(2), char(3), '…', 12) AS title_snippet,
+                   snippet(search_index, 1, char(2), char(3), '…', 24) AS body_snippet
+            FROM search_index JOIN thread ON thread.id = search_index.thread_id
+            WHERE search_index MATCH :query {keyset}
+            ORDER BY search_index.rank, search_index.rowid
+            LIMIT :limit"""), params).all()
+        results = rows[:app.config['SEARCH_PAGE_SIZE']]
+        if len(rows) > len(results):
+            next_cursor = encode_cursor(results[-1].rank, results[-1].rowid)
+    return render_template('search.html', title=f'Arama: {q} - MAHKEME Forum' if q else 'Arama - MAHKEME Forum',
+                           q=q, results=results, next_cursor=next_cursor)
+
+def inbox_conversations(me):
+    """Each conversation of ``me`` with its latest message and unread count, newest first.
+
+    One statement: the sent and received sides are read through their own indexes,
+    then window functions pick the latest row and sum the unread ones per peer.
+    """
+    columns = [Message.id, Message.content, Message.sender_id, Message.receiver_id, Message.created_at,
+               Message.is_read]
+    sent = db.select(*columns, Message.receiver_id.label('peer_id')).where(Message.sender_id == me)
+    received = (db.select(*columns, Message.sender_id.label('peer_id'))
+                .where(Message.receiver_id == me, Message.sender_id != me))
+    mine = db.union_all(sent, received).subquery()
+    newest_first = (mine.c.created_at.desc(), mine.c.id.desc())
+    is_unread = db.case(((mine.c.receiver_id == me) & (mine.c.is_read == db.false()), 1), else_=0)
+    ranked = db.select(
+        mine,
+        db.func.row_number().over(partition_by=mine.c.peer_id, order_by=newest_first).label('position'),
+        db.func.sum(is_unread).over(partition_by=mine.c.peer_id).label('unread'),
+    ).subquery()
+    stmt = (db.select(ranked, User.username, User.profile_pic)
+            .join(User, User.id == ranked.c.peer_id)
+            .where(ranked.c.position == 1)
+            .order_by(ranked.c.created_at.desc(), ranked.c.id.desc()))
+    return db.session.execute(stmt).all()
+
+@app.route('/inbox')
+@login_required
+def inbox():
+    conversations = inbox_conversations(current_user.id)
+    return render_template('inbox.html', title='Mesajlar - MAHKEME Forum', conversations=conversations)
 
 @app.route('/chat/<int:user_id>', methods=['GET', 'POST'])
 @login_required
@@ -763,55 +2360,616 @@ def chat(user_id):
         if content:
             msg = Message(
                 content=content, 
+                content_html=render_body(content),
                 sender_id=current_user.id, 
                 receiver_id=user_id
             )
             db.session.add(msg)
             db.session.commit()
+            message_notifier.publish(msg.id, current_user.id, user_id)
+            unread_counter.adjust(user_id, 1)
             flash('Mesajınız gönderildi!', 'success')
         else:
             flash('Mesaj içeriği boş olamaz!', 'danger')
         return redirect(url_for('chat', user_id=user_id))
-    Message.query.filter_by(sender_id=user_id, receiver_id=current_user.id, is_read=False).update({'is_read': True})
+    mark_conversation_read(current_user.id, user_id)
+    page = chat_history_page(current_user.id, user_id, per_page=app.config['CHAT_PAGE_SIZE'])
+    return render_template('chat.html', title=f'Mesaj: {receiver.username} - MAHKEME Forum', receiver=receiver,
+                           messages=page.items, older_cursor=page.prev_cursor)
+
+def mark_conversation_read(me, peer):
+    """Mark the messages ``peer`` sent to ``me`` as read."""
+    unread = (Message.receiver_id == me) & (Message.sender_id == peer) & (Message.is_read == db.false())
+    # Only take the write lock when there is something to mark, and do it in its own
+    # transaction so the user rows already loaded for this page are not expired.
+    if db.session.query(db.exists().where(unread)).scalar():
+        with db.engine.begin() as conn:
+            marked = conn.execute(db.update(Message).where(unread).values(is_read=True)).rowcount
+        unread_counter.adjust(me, -marked)
+
+@app.route('/chat/<int:user_id>/older')
+@login_required
+def chat_older(user_id):
+    """The page of messages before the ``before`` cursor, as rendered HTML plus the next cursor."""
+    receiver = User.query.get_or_404(user_id)
+    before = decode_cursor(request.args.get('before', ''), datetime, int) or abort(400)
+    page = chat_history_page(current_user.id, user_id, before=before, per_page=app.config['CHAT_PAGE_SIZE'])
+    return {
+        'html': render_template('_chat_messages.html', messages=page.items, receiver=receiver),
+        'older_url': url_for('chat_older', user_id=user_id, before=page.prev_cursor) if page.prev_cursor else None,
+    }
+
+@app.route('/chat/<int:user_id>/stream')
+@login_required
+def chat_stream(user_id):
+    """Server-Sent Events feed of messages in this conversation newer than the last one seen."""
+    receiver = User.query.get_or_404(user_id)
+    me = current_user.id
+    last_id = request.headers.get('Last-Event-ID', type=int) or request.args.get('after', 0, type=int)
+    key = conversation_key(me, user_id)
+    conversation = (((Message.sender_id == me) & (Message.receiver_id == user_id)) |
+                    ((Message.sender_id == user_id) & (Message.receiver_id == me)))
     db.session.commit()
-    messages = Message.query.filter(
-        ((Message.sender_id == current_user.id) & (Message.receiver_id == user_id)) |
-        ((Message.sender_id == user_id) & (Message.receiver_id == current_user.id))
-    ).order_by(Message.created_at.asc()).all()
-    return render_template_string(BASE_HEADER + '''
-<div class="forum-container">
-    <h2 class="mb-4"><i class="fas fa-comments me-2"></i>{{ receiver.username }} ile Mesajlaşma</h2>
-    <div class="chat-messages">
-        {% for message in messages %}
-        <div class="message-bubble {% if message.sender_id == current_user.id %}message-sent{% else %}message-received{% endif %}">
-            <div class="d-flex justify-content-between align-items-center mb-1">
-                <a href="{{ url_for('user_profile', username=(current_user.username if message.sender_id == current_user.id else receiver.username)) }}" class="fw-bold">
-                    {{ current_user.username if message.sender_id == current_user.id else receiver.username }}
-                </a>
-                <span class="text-muted small">{{ message.created_at.strftime('%d.%m.%Y %H:%M') }}</span>
-            </div>
-            <p class="mb-0">{{ message.content|replace('\n', '<br>')|safe }}</p>
-        </div>
-        {% endfor %}
-    </div>
-    <div class="mt-4">
-        <h5 class="mb-3">Mesaj Gönder</h5>
-        <form method="POST">
-            <div class="mb-3">
-                <textarea class="form-control" name="content" rows="3" placeholder="Mesajınızı yazın..." required></textarea>
-            </div>
-            <button type="submit" class="btn btn-primary">Gönder</button>
-        </form>
-    </div>
-</div>
-<script>
-    document.addEventListener('DOMContentLoaded', function() {
-        scrollChatToBottom();
-    });
-</script>
-''' + BASE_FOOTER, title=f'Mesaj: {receiver.username} - MAHKEME Forum', receiver=receiver, messages=messages, current_user=current_user)
+
+    def new_messages():
+        nonlocal last_id
+        messages = Message.query.filter(conversation, Message.id > last_id).order_by(Message.id).all()
+        unread = [m.id for m in messages if m.receiver_id == me and not m.is_read]
+        if unread:
+            Message.query.filter(Message.id.in_(unread)).update({'is_read': True}, synchronize_session=False)
+            unread_counter.adjust(me, -len(unread))
+        # End the transaction so the stream does not hold a connection while it waits.
+        db.session.commit()
+        for message in messages:
+            html = render_template('_chat_message.html', message=message, receiver=receiver)
+            last_id = message.id
+            yield f"id: {message.id}\ndata: {json.dumps({'id': message.id, 'html': html})}\n\n"
+
+    def events():
+        if not chat_streams.acquire():
+            yield f"retry: {app.config['CHAT_STREAM_BUSY_RETRY'] * 1000}\n\n"
+            yield from new_messages()
+            return
+        message_notifier.subscribe(key)
+        try:
+            yield 'retry: 3000\n\n'
+            deadline = time.monotonic() + app.config['CHAT_STREAM_MAX_SECONDS']
+            # Look in the database once before the first wait: messages stored while no
+            # stream for this conversation was open (between the page render and this
+            # connect, or during a reconnect) may never have been published here.
+            caught_up = False
+            while time.monotonic() < deadline:
+                if caught_up and not message_notifier.wait(key, last_id, app.config['CHAT_STREAM_HEARTBEAT']):
+                    yield ': keep-alive\n\n'
+                    continue
+                caught_up = True
+                yield from new_messages()
+        finally:
+            message_notifier.unsubscribe(key)
+            chat_streams.release()
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def stats_access_allowed():
+    """Whether this request may read the statistics endpoints; see STATS_TOKEN."""
+    if app.config['STATS_TOKEN']:
+        return hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {app.config['STATS_TOKEN']}")
+    forwarded = any(name in request.headers for name in ('Forwarded', 'X-Forwarded-For', 'X-Real-IP'))
+    return request.remote_addr in app.config['STATS_ALLOWED_ADDRS'] and not forwarded
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Request, latency, pool and cache metrics summed over every worker, for Prometheus."""
+    if not stats_access_allowed():
+        abort(404)
+    return Response(render_metrics(metrics.collect()), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/internal/stats')
+def internal_stats():
+    """Cache statistics for this worker process, for local monitoring only."""
+    if not stats_access_allowed():
+        abort(404)
+    return {'pid': os.getpid(), 'caches': {name: cache.stats() for name, cache in CACHES.items()},
+            'password_hasher': password_hasher.stats(), 'jobs': job_runner.stats(),
+            'chat_streams': chat_streams.stats()}
+
+# JSON API
+def api_time(value):
+    return value.isoformat() + 'Z' if value else None
+
+def api_user(user):
+    return {'id': user.id, 'username': user.username} if user else None
+
+# What each API object can carry; `?fields=a,b` picks a subset.
+THREAD_FIELDS = {
+    'id': lambda t: t.id,
+    'title': lambda t: t.title,
+    'author': lambda t: api_user(t.author),
+    'created_at': lambda t: api_time(t.created_at),
+    'updated_at': lambda t: api_time(t.updated_at),
+    'reply_count': lambda t: t.reply_count,
+    'views': lambda t: t.views or 0,
+    'last_post_at': lambda t: api_time(t.last_post_at),
+    'last_poster': lambda t: api_user(t.last_poster),
+    'content': lambda t: t.content,
+    'content_html': lambda t: str(body_html(t)),
+}
+# Listings leave the bodies out unless they are asked for.
+THREAD_LIST_FIELDS = [name for name in THREAD_FIELDS if name not in ('content', 'content_html')]
+POST_FIELDS = {
+    'id': lambda p: p.id,
+    'author': lambda p: api_user(p.author),
+    'created_at': lambda p: api_time(p.created_at),
+    'content': lambda p: p.content,
+    'content_html': lambda p: str(body_html(p)),
+}
+MESSAGE_FIELDS = {
+    'id': lambda m: m.id,
+    'sender_id': lambda m: m.sender_id,
+    'receiver_id': lambda m: m.receiver_id,
+    'created_at': lambda m: api_time(m.created_at),
+    'is_read': lambda m: bool(m.is_read),
+    'content': lambda m: m.content,
+    'content_html': lambda m: str(body_html(m)),
+}
+
+def requested_fields(arg, available, default=None):
+    """The field names listed in query parameter ``arg``, or ``default`` (all of them) if it is absent."""
+    value = request.args.get(arg)
+    if not value:
+        return list(default or available)
+    names = list(dict.fromkeys(value.split(',')))
+    unknown = [name for name in names if name not in available]
+    if unknown:
+        abort(400, f"Unknown {arg}: {', '.join(unknown)}")
+    return names
+
+def serialize(row, available, names):
+    return {name: available[name](row) for name in names}
+
+def api_etag(*values):
+    """A strong ETag for a response built from ``values`` and this request's query string."""
+    return hashlib.sha256(json.dumps([request.full_path, *values], default=str).encode()).hexdigest()
+
+def compact_json(payload):
+    return json.dumps(payload, ensure_ascii=False, separators=(',', ':'))
+
+def api_response(build, etag=None, last_modified=None, private=False):
+    """Compact JSON of ``build()``, or a 304 if the client already has it.
+
+    An ``etag`` computed from what the payload is built from lets a matching
+    request be answered before build() runs; without one, the ETag is a hash of
+    the body.
+    """
+    response = Response(content_type='application/json')
+    response.headers['Cache-Control'] = 'private, no-cache' if private else 'no-cache'
+    body = None
+    if etag is None:
+        body = compact_json(build())
+        etag = hashlib.sha256(body.encode()).hexdigest()
+    checked = conditional_response(response, etag, last_modified)
+    if checked is response:
+        response.set_data(body if body is not None else compact_json(build()))
+    return checked
+
+def api_login_required(view):
+    """login_required for API views: 401 instead of a redirect to the login page."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not current_user.is_authenticated:
+            abort(401)
+        return view(*args, **kwargs)
+    return wrapper
+
+@app.errorhandler(HTTPException)
+def api_error(error):
+    """Errors under /api/ are JSON; everywhere else Werkzeug's own responses are kept."""
+    if not request.path.startswith('/api/') or error.code is None or error.code < 400:
+        return error
+    return {'error': error.name, 'message': error.description}, error.code
+
+@app.route('/api/v1/threads')
+def api_threads():
+    """Threads in /forum order (``sort=recent`` or ``hot``), paged with the same ``after``/``before`` cursors."""
+    sort = requested_thread_sort()
+    after, before = requested_thread_cursors(sort)
+    per_page = requested_page_size('FORUM_PAGE_SIZE', 'FORUM_MAX_PAGE_SIZE')
+    fields = requested_fields('fields', THREAD_FIELDS, THREAD_LIST_FIELDS)
+    query = Thread.query.options(joinedload(Thread.author), joinedload(Thread.last_poster))
+    page = paginate_threads(query, after=after, before=before, per_page=per_page, sort=sort)
+    # A new thread or reply anywhere can shift any page, and always moves the newest
+    # updated_at, which the first page already holds. Views reorder the hot listing
+    # without touching updated_at, so it is only validated by its ETag.
+    if sort == 'hot':
+        newest = None
+    elif page.items and not (after or before):
+        newest = page.items[0].updated_at
+    else:
+        newest = db.session.query(db.func.max(Thread.updated_at)).scalar()
+    return api_response(lambda: {
+        'threads': [serialize(t, THREAD_FIELDS, fields) for t in page.items],
+        'next_cursor': page.next_cursor,
+        'prev_cursor': page.prev_cursor,
+    }, last_modified=newest)
+
+@app.route('/api/v1/threads/<int:thread_id>')
+def api_thread(thread_id):
+    """A thread and one page of its replies, oldest first; ``after`` takes the previous next_cursor.
+
+    Replies are only loaded when the client's copy is out of date. Fetching a thread
+    through the API does not count as a view.
+    """
+    after = None
+    if request.args.get('after'):
+        after = decode_cursor(request.args['after'], datetime, int) or abort(400)
+    per_page = requested_page_size('API_POSTS_PAGE_SIZE', 'API_POSTS_MAX_PAGE_SIZE')
+    fields = requested_fields('fields', THREAD_FIELDS)
+    post_fields = requested_fields('post_fields', POST_FIELDS)
+    thread = Thread.query.options(joinedload(Thread.author), joinedload(Thread.last_poster)).get_or_404(thread_id)
+
+    def build():
+        page = thread_posts_page(thread.id, after=after, per_page=per_page)
+        return {
+            'thread': serialize(thread, THREAD_FIELDS, fields),
+            'posts': [serialize(p, POST_FIELDS, post_fields) for p in page.items],
+            'next_cursor': page.next_cursor,
+        }
+
+    # Every reply moves updated_at; flushed views change nothing else.
+    etag = api_etag(thread.updated_at, thread.reply_count, thread.views if 'views' in fields else None)
+    return api_response(build, etag=etag, last_modified=thread.updated_at)
+
+@app.route('/api/v1/chat/<int:user_id>')
+@api_login_required
+def api_chat(user_id):
+    """The latest page of a conversation, or the page before ``before``, oldest first.
+
+    Like opening /chat/<user_id>, this marks the messages received from that user
+    read. Polling clients get a 304 until a message is sent or, if they asked for
+    is_read, until the other side reads theirs.
+    """
+    User.query.get_or_404(user_id)
+    before = None
+    if request.args.get('before'):
+        before = decode_cursor(request.args['before'], datetime, int) or abort(400)
+    per_page = requested_page_size('CHAT_PAGE_SIZE', 'CHAT_MAX_PAGE_SIZE')
+    fields = requested_fields('fields', MESSAGE_FIELDS)
+    me = current_user.id
+    mark_conversation_read(me, user_id)
+    newest_id, newest_at, unread_by_peer = conversation_state(me, user_id)
+
+    def build():
+        page = chat_history_page(me, user_id, before=before, per_page=per_page)
+        return {
+            'messages': [serialize(m, MESSAGE_FIELDS, fields) for m in page.items],
+            'prev_cursor': page.prev_cursor,
+        }
+
+    etag = api_etag(me, newest_id, unread_by_peer if 'is_read' in fields else None)
+    return api_response(build, etag=etag, last_modified=newest_at, private=True)
+
+# Maintenance commands
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index():
+    """Repopulate the full-text search index from every thread and reply."""
+    if db.engine.dialect.name != 'sqlite':
+        raise click.UsageError('The full-text search index requires SQLite FTS5.')
+    with db.engine.begin() as conn:
+        for statement in REBUILD_SEARCH_INDEX_SQL:
+            conn.exec_driver_sql(statement)
+        count = conn.exec_driver_sql('SELECT count(*) FROM search_index').scalar()
+    click.echo(f'Indexed {count} threads and replies.')
+
+@app.cli.command('db-upgrade')
+def db_upgrade():
+    """Bring the database schema up to the latest version."""
+    applied = upgrade_schema(log=click.echo)
+    click.echo(f'Schema is at version {LATEST_SCHEMA_VERSION} ({applied} migrations applied).')
+
+@app.cli.group('jobs')
+def jobs():
+    """Inspect and manage the background job queue."""
+
+@jobs.command('status')
+def jobs_status():
+    """Job counts by name and state, the scheduler lease and when periodic jobs next run."""
+    rows = db.session.execute(db.select(Job.name, Job.state, db.func.count(), db.func.min(Job.run_at))
+                              .group_by(Job.name, Job.state).order_by(Job.name, Job.state)).all()
+    click.echo(f"{'job':20} {'state':8} {'count':>7}  oldest due")
+    for name, state, count, oldest in rows:
+        click.echo(f"{name:20} {state:8} {count:7}  {oldest if state == 'queued' else ''}")
+    lease = db.session.execute(db.select(job_lease).where(job_lease.c.name == 'scheduler')).first()
+    click.echo(f'Scheduler lease: {lease.holder} until {lease.expires_at}' if lease else 'Scheduler lease: none')
+    for name, spec in JOBS.items():
+        if spec.every is not None:
+            next_run = db.session.execute(db.select(app_state.c.value)
+                                          .where(app_state.c.key == f'next_run:{name}')).scalar()
+            when = datetime.utcfromtimestamp(next_run) if next_run else 'at the next scheduler tick'
+            click.echo(f"{name}: every {app.config[spec.every]} s, next {when}")
+
+@jobs.command('failed')
+@click.option('--limit', default=20, show_default=True)
+def jobs_failed(limit):
+    """The most recent failed jobs with the last line of their error."""
+    for failed in Job.query.filter_by(state='failed').order_by(Job.finished_at.desc()).limit(limit):
+        error = (failed.last_error or '').strip().splitlines()[-1:] or ['']
+        click.echo(f'#{failed.id} {failed.name} {failed.payload} after {failed.attempts} attempts, '
+                   f'{failed.finished_at}: {error[0]}')
+
+@jobs.command('retry')
+@click.argument('job_ids', nargs=-1, type=int)
+@click.option('--all-failed', is_flag=True, help='Retry every failed job.')
+def jobs_retry(job_ids, all_failed):
+    """Queue failed jobs again with a fresh set of attempts."""
+    if not job_ids and not all_failed:
+        raise click.UsageError('Give job ids or --all-failed.')
+    stmt = db.update(Job).where(Job.state == 'failed')
+    if not all_failed:
+        stmt = stmt.where(Job.id.in_(job_ids))
+    result = db.session.execute(stmt.values(state='queued', attempts=0, run_at=datetime.utcnow(), finished_at=None)
+                                .execution_options(synchronize_session=False))
+    db.session.commit()
+    click.echo(f'Queued {result.rowcount} jobs again.')
+
+@jobs.command('enqueue')
+@click.argument('name', type=click.Choice(sorted(JOBS)))
+@click.option('--payload', default='{}', help='Keyword arguments as a JSON object.')
+def jobs_enqueue(name, payload):
+    """Queue a job to be run by the workers (or `flask jobs run`)."""
+    queued = enqueue(name, **json.loads(payload))
+    db.session.commit()
+    click.echo(f'Queued {name} as #{queued.id}.')
+
+@jobs.command('run')
+@click.option('--schedule/--no-schedule', default=False,
+              help='First enqueue due periodic jobs, if no running process holds the scheduler lease.')
+def jobs_run(schedule):
+    """Run due jobs in this process until the queue has none left."""
+    if schedule and not job_runner.schedule():
+        click.echo('Another process holds the scheduler lease; not scheduling.')
+    click.echo(f'Ran {job_runner.run_pending()} jobs ({job_runner.stats()}).')
+
+def thread_counters_update(thread_ids=None):
+    """The bulk UPDATE that recomputes the denormalized reply counters from Post."""
+    replies = db.select(db.func.count(Post.id)).where(Post.thread_id == Thread.id).scalar_subquery()
+    last_at = db.select(db.func.max(Post.created_at)).where(Post.thread_id == Thread.id).scalar_subquery()
+    last_user = (db.select(Post.user_id).where(Post.thread_id == Thread.id)
+                 .order_by(Post.created_at.desc(), Post.id.desc()).limit(1).scalar_subquery())
+    stmt = db.update(Thread).values(reply_count=replies, last_post_at=last_at, last_post_user_id=last_user,
+                                    updated_at=Thread.updated_at)
+    if thread_ids is not None:
+        stmt = stmt.where(Thread.id.in_(thread_ids))
+    return stmt
+
+def rebuild_thread_counters(thread_ids=None):
+    """Recompute the denormalized reply counters from Post in one bulk UPDATE."""
+    result = db.session.execute(thread_counters_update(thread_ids).execution_options(synchronize_session=False))
+    db.session.commit()
+    return result.rowcount
+
+@app.cli.command('rebuild-thread-counters')
+def rebuild_thread_counters_command():
+    """Rebuild Thread.reply_count/last_post_at/last_post_user_id from Post."""
+    click.echo(f'Rebuilt reply counters for {rebuild_thread_counters()} threads.')
+
+@app.cli.command('rebuild-hot-scores')
+def rebuild_hot_scores_command():
+    """Recompute Thread.hot_score from reply times and view counts."""
+    with db.engine.begin() as conn:
+        click.echo(f'Rebuilt hot scores for {rebuild_hot_scores(conn)} threads.')
+    page_cache.invalidate('forum')
+
+# Fixture accounts can be logged in to with a known password, so commands that
+# create them run against a throwaway SQLite database unless --database names one.
+check_database_option = click.option(
+    '--database', metavar='URL', envvar='CHECK_DATABASE_URL',
+    help='Database to create the check fixtures in (migrated first); a temporary SQLite file by default.')
+
+def rerun_in_check_database(database):
+    """Re-run this command in a child process bound to the check database; False in that child.
+
+    The child gets its own DATABASE_URL, page cache and metrics directory, so
+    nothing the command writes reaches the live ones.
+    """
+    if os.environ.get('CHECK_DATABASE_URL') == app.config['SQLALCHEMY_DATABASE_URI']:
+        with app.app_context():
+            upgrade_schema()
+        return False
+    with tempfile.TemporaryDirectory(prefix='forum-check-') as tmp:
+        url = database or 'sqlite:///' + os.path.join(tmp, 'check.db')
+        env = dict(os.environ, DATABASE_URL=url, CHECK_DATABASE_URL=url,
+                   PAGE_CACHE_PATH=os.path.join(tmp, 'page_cache.db'), METRICS_DIR=os.path.join(tmp, 'metrics'))
+        status = subprocess.run([sys.executable, '-m', 'flask', *sys.argv[1:]], env=env).returncode
+    if status:
+        raise SystemExit(status)
+    return True
+
+def ensure_check_fixtures():
+    """Create (or reuse) a small, fixed data set that exercises every page; see rerun_in_check_database."""
+    users = []
+    for username in ('_check_alice', '_check_bob'):
+        user = User.query.filter_by(username=username).first()
+        if user is None:
+            user = User(username=username, password_hash=generate_password_hash('check'))
+            db.session.add(user)
+        users.append(user)
+    db.session.flush()
+    alice, bob = users
+    thread = Thread.query.filter_by(user_id=alice.id).first()
+    if thread is None:
+        thread = Thread(title='Sorgu kontrolü', content='Kontrol içeriği', user_id=alice.id)
+        db.session.add(thread)
+        db.session.flush()
+        for i in range(20):
+            author = alice if i % 2 else bob
+            db.session.add(Post(content=f'Yorum {i}', user_id=author.id, thread_id=thread.id))
+            db.session.add(Message(content=f'Mesaj {i}', sender_id=author.id,
+                                   receiver_id=bob.id if author is alice else alice.id))
+    db.session.commit()
+    rebuild_thread_counters([thread.id])
+    return alice, bob, thread
+
+def check_requests(alice, bob, thread):
+    """The GET requests the route checks run, as (endpoint, url, logged-in user)."""
+    return [
+        ('forum', url_for('forum'), None),
+        ('forum', url_for('forum'), alice),
+        ('forum', url_for('forum', after=encode_cursor(thread.updated_at, thread.id)), None),
+        ('forum', url_for('forum', sort='hot'), None),
+        ('forum', url_for('forum', sort='hot', after=encode_cursor(thread.hot_score, thread.id, time.time())), None),
+        ('thread', url_for('thread', thread_id=thread.id), None),
+        ('thread', url_for('thread', thread_id=thread.id), alice),
+        ('user_profile', url_for('user_profile', username=alice.username), None),
+        ('user_profile', url_for('user_profile', username=alice.username), bob),
+        ('chat', url_for('chat', user_id=bob.id), alice),
+        ('inbox', url_for('inbox'), alice),
+        ('chat_older', url_for('chat_older', user_id=bob.id, before=encode_cursor(datetime.utcnow(), 0)), alice),
+        ('search', url_for('search', q='yorum'), None),
+        ('api_threads', url_for('api_threads'), None),
+        ('api_threads', url_for('api_threads', after=encode_cursor(thread.updated_at, thread.id)), None),
+        ('api_thread', url_for('api_thread', thread_id=thread.id), None),
+        ('api_chat', url_for('api_chat', user_id=bob.id), alice),
+        ('api_chat', url_for('api_chat', user_id=bob.id, before=encode_cursor(datetime.utcnow(), 0)), alice),
+    ]
+
+def clear_process_caches():
+    """Empty the per-process caches, so a checked request runs every statement a cold worker would."""
+    for cache in CACHES.values():
+        if isinstance(cache, TTLCache):
+            cache.clear()
+
+def check_client(user):
+    client = app.test_client()
+    if user is not None:
+        log_in_test_client(client, user)
+    return client
+
+def log_in_test_client(client, user):
+    with client.session_transaction() as sess:
+        sess['_user_id'] = str(user.id)
+        sess['_fresh'] = True
+
+@app.cli.command('check-sql-budgets')
+@check_database_option
+def check_sql_budgets(database):
+    """Fail if any page runs more SQL statements than SQL_STATEMENT_BUDGETS allows."""
+    if rerun_in_check_database(database):
+        return
+    with app.test_request_context():
+        alice, bob, thread = ensure_check_fixtures()
+        requests_to_check = check_requests(alice, bob, thread)
+    counted = []
+    listener = lambda *args: counted.append(1)
+    event.listen(db.engine, 'before_cursor_execute', listener)
+    failures = 0
+    # Measure the views themselves, not cached copies of them.
+    app.config['PAGE_CACHE_ENABLED'] = False
+    request_logger.setLevel(logging.WARNING)
+    try:
+        for endpoint, url, user in requests_to_check:
+            client = check_client(user)
+            clear_process_caches()
+            del counted[:]
+            # A fresh app context gives each request its own `g` and login state.
+            with app.app_context():
+                response = client.get(url)
+            budget = app.config['SQL_STATEMENT_BUDGETS'][endpoint]
+            ok = response.status_code == 200 and len(counted) <= budget
+            failures += not ok
+            who = user.username if user else 'anonymous'
+            click.echo(f"{'ok  ' if ok else 'FAIL'} {url} as {who}: "
+                       f"{len(counted)} statements (budget {budget}), HTTP {response.status_code}")
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', listener)
+    if failures:
+        raise SystemExit(1)
+
+def is_table_scan(step, plan):
+    """Whether an EXPLAIN QUERY PLAN step reads a whole table rather than an index range."""
+    if not step.startswith('SCAN ') or ' USING ' in step or step == 'SCAN CONSTANT ROW':
+        return False
+    # FTS5 reports a MATCH lookup as a virtual table "scan" whose index string contains M.
+    if re.search(r'VIRTUAL TABLE INDEX \d+:\S*M', step):
+        return False
+    # Reading back a subquery's (already limited) result is not a table scan.
+    subqueries = {s.split()[-1] for s in plan if s.startswith(('CO-ROUTINE ', 'MATERIALIZE '))}
+    return step.split()[1] not in subqueries
+
+@app.cli.command('check-query-plans')
+@check_database_option
+def check_query_plans(database):
+    """Fail if any query issued by the checked pages does a full table scan (SQLite only)."""
+    if rerun_in_check_database(database):
+        return
+    if db.engine.dialect.name != 'sqlite':
+        raise click.UsageError('EXPLAIN QUERY PLAN checks only run against SQLite.')
+    with app.test_request_context():
+        requests_to_check = check_requests(*ensure_check_fixtures())
+    captured = {}
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE')):
+            captured.setdefault(statement, (request.endpoint, parameters))
+    event.listen(db.engine, 'before_cursor_execute', capture)
+    try:
+        for endpoint, url, user in requests_to_check:
+            client = check_client(user)
+            clear_process_caches()
+            with app.app_context():
+                client.get(url)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', capture)
+    failures = 0
+    with db.engine.connect() as conn:
+        for statement, (endpoint, parameters) in captured.items():
+            plan = [row[-1] for row in conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters)]
+            scans = [step for step in plan if is_table_scan(step, plan)]
+            failures += bool(scans)
+            click.echo(f"{'FAIL' if scans else 'ok  '} {endpoint}: {' '.join(statement.split())[:100]}")
+            for step in plan:
+                click.echo(f'       {step}')
+    if failures:
+        raise SystemExit(1)
+
+@app.cli.command('backfill-body-html')
+@click.option('--batch-size', default=1000, show_default=True)
+@click.option('--all', 'rerender', is_flag=True, help='Re-render every row, e.g. after changing render_body.')
+def backfill_body_html(batch_size, rerender):
+    """Store render_body(content) for threads, replies and messages that lack it."""
+    for model in (Thread, Post, Message):
+        table = model.__table__
+        update = (db.update(table).where(table.c.id == bindparam('row_id'))
+                  .values(content_html=bindparam('html')))
+        last_id, converted = 0, 0
+        while True:
+            # Keyset batches, each in its own short transaction.
+            query = db.select(table.c.id, table.c.content).where(table.c.id > last_id)
+            if not rerender:
+                query = query.where(table.c.content_html.is_(None))
+            with db.engine.begin() as conn:
+                rows = conn.execute(query.order_by(table.c.id).limit(batch_size)).all()
+                if not rows:
+                    break
+                conn.execute(update, [{'row_id': row.id, 'html': render_body(row.content)} for row in rows])
+            last_id, converted = rows[-1].id, converted + len(rows)
+        click.echo(f'{table.name}: rendered {converted} bodies.')
+    page_cache.clear()
+
+# Compile every template once at startup, after all filters and globals are
+# registered. Under `gunicorn --preload` this runs in the master process, so
+# forked workers share the compiled templates.
+for template_name in app.jinja_env.list_templates(extensions=['html']):
+    app.jinja_env.get_template(template_name)
 
 if __name__ == "__main__":
+    # The single-process development server migrates for convenience; gunicorn
+    # workers only check (see gunicorn.conf.py).
+    with app.app_context():
+        upgrade_schema(log=print)
+    reset_metrics()
+    # With the reloader, only the child process that serves requests runs jobs.
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        job_runner.start()
     port = int(os.environ.get("PORT", 5000))
     app.run(host='0.0.0.0', port=port, debug=True)
 
@@ -0,0 +1,39 @@
+(function () {
+    // New messages arrive over Server-Sent Events; EventSource reconnects on its
+    // own and resumes from the Last-Event-ID it last received.
+    const container = document.querySelector('.chat-messages');
+    const source = new EventSource(container.dataset.streamUrl);
+    // Older history is fetched a page at a time when the user scrolls to the top.
+    let loadingOlder = false;
+    container.addEventListener('scroll', function () {
+        const olderUrl = container.dataset.olderUrl;
+        if (!olderUrl || loadingOlder || container.scrollTop > 50) {
+            return;
+        }
+        loadingOlder = true;
+        fetch(olderUrl, {credentials: 'same-origin'})
+            .then(function (response) { return response.json(); })
+            .then(function (page) {
+                const previousHeight = container.scrollHeight;
+                container.insertAdjacentHTML('afterbegin', page.html);
+                container.scrollTop += container.scrollHeight - previousHeight;
+                if (page.older_url) {
+                    container.dataset.olderUrl = page.older_url;
+                } else {
+                    delete container.dataset.olderUrl;
+                }
+            })
+            .finally(function () { loadingOlder = false; });
+    });
+    source.onmessage = function (event) {
+        const message = JSON.parse(event.data);
+        if (document.getElementById('message-' + message.id)) {
+            return;
+        }
+        const atBottom = container.scrollHeight - container.scrollTop - container.clientHeight < 40;
+        container.insertAdjacentHTML('beforeend', message.html);
+        if (atBottom) {
+            scrollChatToBottom();
+        }
+    };
+})();
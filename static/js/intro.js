@@ -0,0 +1,20 @@
+const introText = `root@kali:~$ sudo systemctl start mahkeme-forum
+[OK] Initializing mahkeme Forum Network...
+[OK] System Root Login Successful
+[OK] Accessing Cehennem Interface...`;
+const introElement = document.getElementById('intro-text');
+let i = 0;
+const typingSpeed = 30;
+function typeWriter() {
+    if (i < introText.length) {
+        introElement.textContent += introText.charAt(i);
+        i++;
+        setTimeout(typeWriter, typingSpeed);
+    } else {
+        const remainingTime = 4000 - (i * typingSpeed);
+        setTimeout(() => {
+            window.location.href = introElement.dataset.nextUrl;
+        }, remainingTime > 0 ? remainingTime : 0);
+    }
+}
+typeWriter();